@@ -0,0 +1,7 @@
+#!/usr/bin/env fish
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2023 Nathan Chancellor
+
+function build_admission -d "Wrapper for build_admission.py"
+    $PYTHON_SCRIPTS_FOLDER/build_admission.py $argv
+end
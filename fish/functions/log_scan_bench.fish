@@ -0,0 +1,7 @@
+#!/usr/bin/env fish
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2023 Nathan Chancellor
+
+function log_scan_bench -d "Wrapper for log_scan_bench.py"
+    $PYTHON_SCRIPTS_FOLDER/log_scan_bench.py $argv
+end
@@ -0,0 +1,7 @@
+#!/usr/bin/env fish
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2023 Nathan Chancellor
+
+function tuxmake_results -d "Wrapper for tuxmake_results.py"
+    $PYTHON_SCRIPTS_FOLDER/tuxmake_results.py $argv
+end
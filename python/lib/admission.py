@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2023 Nathan Chancellor
+
+import json
+import os
+from pathlib import Path
+import socket
+
+from . import utils
+
+
+# BUILD_ADMISSION_SOCKET allows pointing containers or other users at a
+# socket that has been placed in a shared location
+def get_socket_path():
+    if (socket_path := os.environ.get('BUILD_ADMISSION_SOCKET')):
+        return Path(socket_path)
+    if (runtime_dir := os.environ.get('XDG_RUNTIME_DIR')):
+        return Path(runtime_dir, 'build_admission.sock')
+    return Path('/tmp', f"build_admission-{os.getuid()}.sock")
+
+
+def connect(socket_path=None):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(socket_path or get_socket_path()))
+    except OSError:
+        sock.close()
+        raise
+    return sock, sock.makefile(encoding='utf-8')
+
+
+def send(sock, message):
+    sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+# Job slots are held for as long as the connection to the daemon is open, so
+# they are given back even if the build is killed
+class Lease:
+
+    def __init__(self, slots, sock=None, reader=None):
+        self.slots = slots
+        self.sock = sock
+        self.reader = reader
+
+    def release(self):
+        if self.sock:
+            self.reader.close()
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.release()
+
+
+# Wait until the daemon hands out between min_slots and slots job slots. If
+# the daemon is not running, the build goes ahead with the slots it asked for.
+def acquire(slots, name, min_slots=1, socket_path=None):
+    try:
+        sock, reader = connect(socket_path)
+    except OSError:
+        utils.print_yellow(
+            'WARNING: build admission daemon is not running, continuing without a lease...')
+        return Lease(slots)
+
+    request = {
+        'cmd': 'acquire',
+        'min_slots': max(1, min(min_slots, slots)),
+        'name': name,
+        'pid': os.getpid(),
+        'slots': slots,
+        'user': os.environ.get('USER', str(os.getuid())),
+    }
+    send(sock, request)
+    for line in reader:
+        if 'error' in (reply := json.loads(line)):
+            raise RuntimeError(f"Build admission daemon rejected request: {reply['error']}")
+        if 'queued' in reply:
+            utils.print_yellow(f"Waiting for job slots ({reply['queued']} builds ahead, "
+                               f"{reply['free']} of {reply['capacity']} slots free)...")
+        elif 'granted' in reply:
+            return Lease(reply['granted'], sock, reader)
+
+    reader.close()
+    sock.close()
+    raise RuntimeError('Build admission daemon closed the connection without granting slots?')
+
+
+def get_status(socket_path=None):
+    sock, reader = connect(socket_path)
+    with sock, reader:
+        send(sock, {'cmd': 'status'})
+        return json.loads(reader.readline())
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2023 Nathan Chancellor
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import tempfile
+import time
+
+from . import utils
+
+# Names of boot images in arch/*/boot
+BOOT_IMAGES = [
+    'Image',
+    'Image.gz',
+    'bzImage',
+    'uImage',
+    'vmlinux.efi',
+    'vmlinuz.efi',
+    'zImage',
+]  # yapf: disable
+
+# Files in the output folder that are needed to boot or install a kernel
+OTHER_ARTIFACTS = [
+    '.config',
+    'Module.symvers',
+    'System.map',
+    'modules.builtin',
+    'modules.builtin.modinfo',
+    'modules.order',
+]  # yapf: disable
+
+
+def get_cache_folder():
+    return Path(utils.get_cache_folder(), 'kernel_artifacts')
+
+
+def parse_size(size):
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    if (size := str(size).upper())[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def git(kernel_src, cmd):
+    return subprocess.run(['git', *cmd], capture_output=True, check=True, cwd=kernel_src).stdout
+
+
+# The source is identified by the commit plus any changes on top of it,
+# including new files that have not been added to git yet
+def hash_source(kernel_src):
+    sha256 = hashlib.sha256()
+    sha256.update(git(kernel_src, ['rev-parse', 'HEAD']))
+    sha256.update(git(kernel_src, ['diff', '--binary', 'HEAD']))
+    untracked = git(kernel_src, ['ls-files', '-z', '--exclude-standard', '--others'])
+    for file in filter(None, untracked.split(b'\0')):
+        sha256.update(file)
+        sha256.update(Path(kernel_src, file.decode('utf-8')).read_bytes())
+    return sha256.hexdigest()
+
+
+# CC is left out of the variables because it only says how the compiler is
+# invoked (for example, through ccache), which compiler_info covers, and O is
+# left out because it does not affect the result of the build.
+def get_cache_key(kernel_src, out_dir, compiler_info, variables, targets):
+    key_data = {
+        'compiler': [compiler_info['version'], compiler_info['target'], compiler_info['stamp']],
+        'config': utils.hash_file(Path(out_dir, '.config')),
+        'source': hash_source(kernel_src),
+        'targets': targets,
+        'variables': {
+            key: str(value)
+            for key, value in variables.items() if key not in ('CC', 'O')
+        },
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_artifacts(out_dir):
+    artifacts = [item for item in OTHER_ARTIFACTS if Path(out_dir, item).is_file()]
+
+    for boot in Path(out_dir, 'arch').glob('*/boot'):
+        artifacts += [
+            str(Path(boot, image).relative_to(out_dir)) for image in BOOT_IMAGES
+            if Path(boot, image).is_file()
+        ]
+
+    # modules.order lists the objects of modules in newer kernels and the
+    # modules themselves in older kernels
+    if (modules_order := Path(out_dir, 'modules.order')).exists():
+        for module in modules_order.read_text(encoding='utf-8').splitlines():
+            if Path(out_dir, module := str(Path(module).with_suffix('.ko'))).is_file():
+                artifacts.append(module)
+
+    return artifacts
+
+
+def copy_files(src, dst, files):
+    for file in files:
+        Path(dst, file).parent.mkdir(exist_ok=True, parents=True)
+        shutil.copy2(Path(src, file), Path(dst, file))
+
+
+def restore(key, out_dir):
+    if not (metadata_file := Path(get_cache_folder(), key, 'metadata.json')).exists():
+        return None
+    metadata = json.loads(metadata_file.read_text(encoding='utf-8'))
+    copy_files(Path(metadata_file.parent, 'files'), out_dir, metadata['files'])
+    # The modification time of the metadata tracks when an entry was last used
+    os.utime(metadata_file)
+    return metadata['files']
+
+
+# Remove the least recently used entries until the cache fits in its limit
+def evict(size_limit):
+    entries = []
+    for metadata_file in get_cache_folder().glob('*/metadata.json'):
+        metadata = json.loads(metadata_file.read_text(encoding='utf-8'))
+        entries.append((metadata_file.stat().st_mtime, metadata['size'], metadata_file.parent))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= size_limit:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def store(key, out_dir, size_limit):
+    if (entry := Path(get_cache_folder(), key)).exists():
+        return
+
+    files = get_artifacts(out_dir)
+    entry.parent.mkdir(exist_ok=True, parents=True)
+    # Populate the entry under a temporary name so that other builds never see
+    # a partial entry
+    tmp_entry = Path(tempfile.mkdtemp(dir=entry.parent, prefix=f".{key}."))
+    copy_files(out_dir, Path(tmp_entry, 'files'), files)
+    metadata = {
+        'files': files,
+        'size': sum(Path(out_dir, file).stat().st_size for file in files),
+        'time': time.time(),
+    }
+    utils.write_json(Path(tmp_entry, 'metadata.json'), metadata)
+    try:
+        tmp_entry.rename(entry)
+    except OSError:
+        # Another build stored the same entry first
+        shutil.rmtree(tmp_entry)
+
+    evict(size_limit)
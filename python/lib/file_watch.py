@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2023 Nathan Chancellor
+
+import ctypes
+import ctypes.util
+import os
+from pathlib import Path
+import select
+import time
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+# Waits for files in a folder to be created or written to with inotify, which
+# is available in libc without any extra modules
+class InotifyWatcher:
+
+    def __init__(self, folder):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if (fd := libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)) < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+        mask = IN_CLOSE_WRITE | IN_CREATE | IN_MODIFY | IN_MOVED_TO
+        if libc.inotify_add_watch(fd, str(folder).encode('utf-8'), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, f"inotify_add_watch() failed for {folder}")
+        self.fd = fd
+
+    # Returns whether anything happened before the timeout. The events
+    # themselves are not needed, as callers look at the whole folder.
+    def wait(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+# For systems or file systems without inotify, such as some network mounts
+class PollingWatcher:
+
+    def __init__(self, folder, interval=1):
+        self.folder = Path(folder)
+        self.interval = interval
+        self.snapshot = self.get_snapshot()
+
+    def get_snapshot(self):
+        snapshot = {}
+        for item in self.folder.iterdir():
+            stat = item.stat()
+            snapshot[item.name] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def wait(self, timeout):
+        end = time.monotonic() + timeout
+        while (remaining := end - time.monotonic()) > 0:
+            time.sleep(min(self.interval, remaining))
+            if (snapshot := self.get_snapshot()) != self.snapshot:
+                self.snapshot = snapshot
+                return True
+        return False
+
+    def close(self):
+        pass
+
+
+def get_watcher(folder):
+    try:
+        return InotifyWatcher(folder)
+    except (AttributeError, OSError):
+        return PollingWatcher(folder)
@@ -2,12 +2,21 @@
 # SPDX-License-Identifier: MIT
 # Copyright (C) 2022-2023 Nathan Chancellor
 
+import gzip
+import lzma
 import os
 from pathlib import Path
+import re
 import shutil
 import subprocess
+import sys
+import tempfile
 import time
 
+from . import admission
+from . import artifacts
+from . import log_scan
+from . import timeline
 from . import utils
 
 
@@ -17,12 +26,514 @@ def get_tool_version(binary_path):
                           text=True).stdout.splitlines()[0]
 
 
-def kmake(variables, targets, ccache=True, directory=None, jobs=None, silent=True, use_time=False):
+def get_probe_cache_file():
+    return Path(utils.get_cache_folder(), 'tool_probes.json')
+
+
+# Running every tool to get its version adds up quickly over many builds, so
+# cache the results. The entries are keyed on the path that the tool is
+# invoked as, since clang behaves differently depending on its name, and they
+# are invalidated when the resolved binary changes, such as when a toolchain
+# is reinstalled.
+def probe_tool(binary_path, compiler=False):
+    binary_path = Path(binary_path).absolute()
+    resolved = binary_path.resolve()
+    stat = resolved.stat()
+    stamp = [str(resolved), stat.st_ino, stat.st_mtime_ns, stat.st_size]
+
+    cache = utils.read_json(cache_file := get_probe_cache_file())
+    probe = cache.get(str(binary_path))
+    if probe and probe['stamp'] == stamp and (not compiler or 'target' in probe):
+        return probe
+
+    probe = {
+        'stamp': stamp,
+        'version': get_tool_version(binary_path),
+    }
+    if compiler:
+        probe['identity'] = 'clang' if 'clang' in probe['version'] else 'gcc'
+        probe['target'] = subprocess.run([binary_path, '-dumpmachine'],
+                                         capture_output=True,
+                                         check=True,
+                                         text=True).stdout.strip()
+
+    # Another process may have updated the cache while probing
+    cache = utils.read_json(cache_file)
+    cache[str(binary_path)] = probe
+    utils.write_json(cache_file, cache)
+
+    return probe
+
+
+def get_srcarch(arch):
+    return {
+        'i386': 'x86',
+        'x86_64': 'x86',
+        'sparc32': 'sparc',
+        'sparc64': 'sparc',
+    }.get(arch, arch)
+
+
+def get_tree_index_file():
+    return Path(utils.get_cache_folder(), 'tree_capabilities.json')
+
+
+# Configuration targets that Kconfig handles for every architecture, such as
+# 'olddefconfig' or 'localyesconfig', from scripts/kconfig/Makefile
+def get_kconfig_targets(kernel_src):
+    if not (kconfig_makefile := Path(kernel_src, 'scripts/kconfig/Makefile')).exists():
+        return []
+    targets = set()
+    for line in kconfig_makefile.read_text(encoding='utf-8').splitlines():
+        if not line.startswith('#'):
+            # Skip paths, variables and pattern rules like '%_defconfig'
+            targets.update(re.findall(r'(?<![\w/$%.-])[a-z][a-z0-9]*config\b', line))
+    return sorted(targets)
+
+
+def get_config_files(folder):
+    return sorted(item.name for item in folder.iterdir()) if folder.exists() else []
+
+
+# Figuring out what a tree supports requires reading the top level Makefile
+# and looking for files, which is wasteful for back to back builds of the same
+# tree, so keep an index of each tree's capabilities. The entries are
+# invalidated when the top level Makefile, scripts/Makefile.clang,
+# scripts/kconfig/Makefile, the list of architectures, or the configurations
+# in kernel/configs or arch/*/configs change, which covers checking out a
+# different revision.
+def get_tree_capabilities(kernel_src):
+    kernel_src = Path(kernel_src).resolve()
+    items = ['Makefile', 'arch', 'scripts/Makefile.clang']
+    # Configuration targets can be added without touching anything above
+    items += ['kernel/configs', 'scripts/kconfig/Makefile']
+    items += sorted(str(path.relative_to(kernel_src)) for path in kernel_src.glob('arch/*/configs'))
+    stamp = []
+    for item in items:
+        if (path := Path(kernel_src, item)).exists():
+            stat = path.stat()
+            stamp += [item, stat.st_ino, stat.st_mtime_ns, stat.st_size]
+
+    index = utils.read_json(index_file := get_tree_index_file())
+    if (capabilities := index.get(str(kernel_src))) and capabilities['stamp'] == stamp:
+        return capabilities
+
+    makefile_text = Path(kernel_src, 'Makefile').read_text(encoding='utf-8')
+    version_parts = []
+    for variable in ('VERSION', 'PATCHLEVEL', 'SUBLEVEL', 'EXTRAVERSION'):
+        match = re.search(f"^{variable} = (.*)$", makefile_text, flags=re.M)
+        version_parts.append(match.groups()[0].strip() if match else '')
+    version = '.'.join(part for part in version_parts[0:3] if part) + version_parts[3]
+
+    # Architectures and the configuration targets that only they have, such as
+    # their defconfigs
+    arches = {}
+    for item in sorted(Path(kernel_src, 'arch').iterdir()):
+        if Path(item, 'Kconfig').exists():
+            arches[item.name] = get_config_files(Path(item, 'configs'))
+    fragments = get_config_files(Path(kernel_src, 'kernel/configs'))
+
+    capabilities = {
+        'arch_config_targets': arches,
+        'arches': list(arches),
+        # Configuration targets that are available for every architecture
+        'config_targets': get_kconfig_targets(kernel_src) + fragments,
+        # Account for implicit LLVM_IAS change in f12b034afeb3
+        # ("scripts/Makefile.clang: default to LLVM_IAS=1")
+        'llvm_ias_default': 1 if Path(kernel_src, 'scripts/Makefile.clang').exists() else 0,
+        # LLVM=<prefix>/ and LLVM=-<version> support came with LLVM_PREFIX
+        'llvm_prefix': 'LLVM_PREFIX' in makefile_text,
+        'stamp': stamp,
+        'version': version,
+    }
+
+    index = utils.read_json(index_file)
+    index[str(kernel_src)] = capabilities
+    utils.write_json(index_file, index)
+
+    return capabilities
+
+
+def get_config_targets(capabilities, arch):
+    return capabilities['config_targets'] + capabilities['arch_config_targets'].get(
+        get_srcarch(arch), [])
+
+
+def get_out_dir(kernel_src, variables):
+    # O is relative to the kernel source because of 'make -C'
+    return Path(kernel_src, variables.get('O', '.'))
+
+
+# Map the C and assembly files that changed since base_ref (including changes
+# in the working tree and new files) to the objects that they produce, so that
+# only those objects have to be built to check them.
+def get_changed_objects(kernel_src, variables, base_ref):
+    if not Path(out_dir := get_out_dir(kernel_src, variables), '.config').exists():
+        raise RuntimeError(f"Output folder ('{out_dir}') has not been configured?")
+
+    files = []
+    for git_cmd in (
+        ['diff', '--name-only', '--diff-filter=d', base_ref],
+        ['ls-files', '--exclude-standard', '--others'],
+    ):
+        files += subprocess.run(['git', *git_cmd],
+                                capture_output=True,
+                                check=True,
+                                cwd=kernel_src,
+                                text=True).stdout.splitlines()
+
+    objects = []
+    for file in sorted(set(files)):
+        if Path(file).suffix not in ('.c', '.S') or file.endswith('.lds.S'):
+            continue
+        # Host programs and userspace tools cannot be built as single targets
+        if file.startswith(('scripts/', 'tools/')):
+            continue
+        # If the folder does not exist in the output folder, nothing in it is
+        # built with the current configuration.
+        if not Path(out_dir, file).parent.exists():
+            utils.print_yellow(f"WARNING: {file} is not built with this configuration, skipping...")
+            continue
+        objects.append(str(Path(file).with_suffix('.o')))
+
+    if any(Path(file).suffix == '.h' for file in files):
+        utils.print_yellow('WARNING: Changed headers are not accounted for, only changed C and '
+                           'assembly files are built!')
+
+    return objects
+
+
+def get_mem_available():
+    for line in Path('/proc/meminfo').read_text(encoding='utf-8').splitlines():
+        if line.startswith('MemAvailable:'):
+            return int(line.split()[1]) * 1024
+    return None
+
+
+# Rough amount of memory that each job needs at its peak, so that the number
+# of jobs can be limited on machines that do not have enough memory for one
+# job per CPU. LTO is accounted for separately because of the final link,
+# which is a single job that uses a lot of memory.
+def get_job_mem_estimate(cc_is_clang, targets):
+    gib = 1024**3
+    estimate = gib if cc_is_clang else gib // 2
+    if any(target in ('allmodconfig', 'allyesconfig') for target in targets):
+        estimate += estimate // 2
+    return estimate
+
+
+def get_dir_size(folder):
+    return sum(
+        Path(root, file).lstat().st_size for root, _, files in os.walk(folder) for file in files)
+
+
+def get_output_sizes_file():
+    return Path(utils.get_cache_folder(), 'kmake_output_sizes.json')
+
+
+# Configuration targets that start from scratch, rather than from the
+# configuration that is already in the output folder like 'olddefconfig'
+def creates_config(target):
+    if target in ('defconfig', 'randconfig', 'tinyconfig') or target.endswith('_defconfig'):
+        return True
+    return target.startswith('all') and target.endswith('config')
+
+
+# The same targets can produce very different amounts of output depending on
+# the configuration, such as 'olddefconfig all' with different distribution
+# configurations, so the configuration that the build starts from is part of
+# the key unless the targets create a new one.
+def get_output_size_key(out_dir, variables, targets):
+    size_key = f"{variables.get('ARCH', os.uname().machine)} {' '.join(targets)}"
+    config = Path(out_dir, '.config')
+    if not any(creates_config(target) for target in targets) and config.exists():
+        size_key += f" {utils.hash_file(config)[0:12]}"
+    return size_key
+
+
+def record_output_size(size_key, size):
+    sizes = utils.read_json(sizes_file := get_output_sizes_file())
+    sizes[size_key] = size
+    utils.write_json(sizes_file, sizes)
+
+
+# Build in RAM if the output of the same build fit last time, leaving enough
+# memory for the jobs themselves. Returns the output folder to use in RAM (or
+# None to build on disk) and the reason why.
+def get_tmpfs_out_dir(tmpfs_folder, size_key, job_mem):
+    if not (estimate := utils.read_json(get_output_sizes_file()).get(size_key)):
+        return None, 'no size history for this build yet'
+    # Leave some room for the output to grow between builds
+    estimate += estimate // 4
+    mib = 1024**2
+    if estimate > (tmpfs_free := shutil.disk_usage(tmpfs_folder).free):
+        return None, (f"needs {estimate // mib} MiB but {tmpfs_folder} only has "
+                      f"{tmpfs_free // mib} MiB free")
+    if (mem_available := get_mem_available()) and estimate + job_mem > mem_available:
+        return None, (f"needs {(estimate + job_mem) // mib} MiB with jobs but only "
+                      f"{mem_available // mib} MiB of memory is available")
+    tmpfs_out_dir = Path(tempfile.mkdtemp(dir=tmpfs_folder, prefix='kmake-'))
+    return tmpfs_out_dir, f"estimated size: {estimate // mib} MiB"
+
+
+def sync_tmpfs_build(tmpfs_out_dir, out_dir, files):
+    out_dir.mkdir(exist_ok=True, parents=True)
+    artifacts.copy_files(tmpfs_out_dir, out_dir, files)
+
+
+def get_lto_link_mem_estimate(out_dir, targets):
+    if (config := Path(out_dir, '.config')).exists():
+        if 'CONFIG_LTO_CLANG=y' not in config.read_text(encoding='utf-8'):
+            return 0
+    elif not any('lto' in target for target in targets):
+        return 0
+    gib = 1024**3
+    return 16 * gib if 'allmodconfig' in targets else 8 * gib
+
+
+# Pick a number of jobs that uses the CPUs that are not busy with other work,
+# without using more memory than is available, so that shared machines do not
+# start swapping or OOM killing links.
+def get_adaptive_jobs(cc_is_clang, out_dir, targets):
+    cpus = os.cpu_count()
+    idle_cpus = max(1, cpus - int(os.getloadavg()[0]))
+    if not (mem_available := get_mem_available()):
+        return idle_cpus, f"{idle_cpus} idle CPUs"
+
+    mem_available -= get_lto_link_mem_estimate(out_dir, targets)
+    mem_jobs = max(1, mem_available // get_job_mem_estimate(cc_is_clang, targets))
+    jobs = min(idle_cpus, mem_jobs)
+    return jobs, f"{idle_cpus} idle CPUs, enough memory for {mem_jobs} jobs"
+
+
+# Number of compile slots for each host in a distcc host list, using distcc's
+# defaults when there is no explicit limit ('host/limit')
+def get_distcc_slots(hosts):
+    slots = {}
+    for host in hosts.split():
+        # Options such as '--randomize' and '+zeroconf' are not hosts
+        if host.startswith(('-', '+')):
+            continue
+        name, _, limit = host.partition('/')
+        if limit:
+            slots[name] = int(limit.split(',')[0])
+        else:
+            slots[name] = 2 if name == 'localhost' else 4
+    return slots
+
+
+def get_ccache_stats(env):
+    ccache_cmd = ['ccache', '--print-stats']
+    # '--print-stats' is only available in ccache 4.x
+    if (proc := subprocess.run(ccache_cmd, capture_output=True, check=False, env=env,
+                               text=True)).returncode:
+        return None
+    stats = {}
+    for line in proc.stdout.splitlines():
+        if len(parts := line.split('\t')) == 2 and parts[1].isdigit():
+            stats[parts[0]] = int(parts[1])
+    return stats
+
+
+# The statistics are for the whole cache directory, so other builds using the
+# same cache at the same time will show up in the difference.
+def get_ccache_delta(before, after):
+    delta = {key: after.get(key, 0) - before.get(key, 0) for key in after}
+    hits = delta.get('direct_cache_hit', 0) + delta.get('preprocessed_cache_hit', 0)
+    misses = delta.get('cache_miss', 0)
+    return {
+        'bytes_added': delta.get('cache_size_kibibyte', 0) * 1024,
+        'direct_hits': delta.get('direct_cache_hit', 0),
+        'hit_rate': hits / (hits + misses) if hits + misses else 0,
+        'hits': hits,
+        'misses': misses,
+        'preprocessed_hits': delta.get('preprocessed_cache_hit', 0),
+    }
+
+
+def print_ccache_delta(delta):
+    print(f"ccache: {delta['hits']} hits ({delta['direct_hits']} direct, "
+          f"{delta['preprocessed_hits']} preprocessed), {delta['misses']} misses, "
+          f"{delta['hit_rate'] * 100:.1f}% hit rate, "
+          f"{delta['bytes_added'] / 1024**2:+.1f} MiB in cache")
+
+
+# Mixing many different compilers in one cache causes them to evict each
+# other's objects, so give each compiler its own cache next to the default one
+def get_ccache_partition(compiler_info):
+    if not (ccache_dir := os.environ.get('CCACHE_DIR')):
+        ccache_dir = subprocess.run(['ccache', '--get-config', 'cache_dir'],
+                                    capture_output=True,
+                                    check=True,
+                                    text=True).stdout.strip()
+    ccache_dir = Path(ccache_dir)
+
+    if (match := re.search(r'\d+(\.\d+)+', compiler_info['version'])):
+        version = match.group(0)
+    else:
+        version = 'unknown'
+    partition = f"{compiler_info['identity']}-{version}"
+    # Each GCC binary only supports one target
+    if compiler_info['identity'] == 'gcc':
+        partition += f"-{compiler_info['target']}"
+
+    return ccache_dir.with_name(f"{ccache_dir.name}-{partition}")
+
+
+def open_log(log_file):
+    (log_file := Path(log_file)).parent.mkdir(exist_ok=True, parents=True)
+    if log_file.suffix == '.gz':
+        return gzip.open(log_file, 'wb')
+    if log_file.suffix == '.xz':
+        return lzma.open(log_file, 'wb')
+    return log_file.open('wb')
+
+
+# Copy the output of the build to the terminal and a log file while looking
+# for problems, so that the problems are known as soon as the build finishes
+# without having to read the log again.
+def tee_output(stream, log, src_folder, build_timeline=None):
+    problem_re = log_scan.get_problem_re()
+    # dict as an ordered set
+    problems = {}
+    for line in stream:
+        sys.stdout.buffer.write(line)
+        sys.stdout.buffer.flush()
+        if log:
+            log.write(line)
+        text = line.decode('utf-8', errors='replace')
+        if build_timeline:
+            build_timeline.add_line(text)
+        if problem_re.search(text):
+            problems[log_scan.clean_line(text, src_folder)] = None
+    return list(problems)
+
+
+def print_problem_summary(problems, filtered):
+    utils.print_green(
+        f"\nProblems:\033[0m {len(problems)} found, {len(filtered)} after filtering\n")
+    if filtered:
+        print(''.join(filtered), end='')
+
+
+# Run a command and collect the resource usage of it and all of its children,
+# which is what 'time -v' reports, without relying on an external binary
+def run_with_rusage(cmd, env=None, tee=None):
+    pipe_kwargs = {'stdout': subprocess.PIPE, 'stderr': subprocess.STDOUT} if tee else {}
+    with subprocess.Popen(cmd, env=env, **pipe_kwargs) as proc:
+        start_time = time.time()
+        if tee:
+            tee(proc.stdout)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall_time = time.time() - start_time
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+    return {
+        'block_input_ops': rusage.ru_inblock,
+        'block_output_ops': rusage.ru_oublock,
+        'involuntary_context_switches': rusage.ru_nivcsw,
+        # ru_maxrss is in kilobytes on Linux
+        'max_rss_bytes': rusage.ru_maxrss * 1024,
+        'returncode': proc.returncode,
+        'system_time': rusage.ru_stime,
+        'user_time': rusage.ru_utime,
+        'voluntary_context_switches': rusage.ru_nvcsw,
+        'wall_time': wall_time,
+    }
+
+
+# What kmake() did and how it went, so that callers can aggregate and
+# persist information about builds without scraping the output
+class BuildResult:
+
+    def __init__(self, compiler, compiler_version, binutils_version, make_cmd, out_dir):
+        self.compiler = compiler
+        self.compiler_version = compiler_version
+        self.binutils_version = binutils_version
+        self.make_cmd = [str(item) for item in make_cmd]
+        self.out_dir = out_dir
+
+        self.artifact_cache_hit = None
+        self.artifacts = []
+        self.ccache = None
+        self.filtered_problems = None
+        self.phases = None
+        self.problems = None
+        self.returncode = None
+        self.rusage = {}
+
+    @property
+    def wall_time(self):
+        return self.rusage.get('wall_time', 0)
+
+    @property
+    def cpu_time(self):
+        return self.rusage.get('user_time', 0) + self.rusage.get('system_time', 0)
+
+    @property
+    def max_rss_bytes(self):
+        return self.rusage.get('max_rss_bytes', 0)
+
+    def to_dict(self):
+        return {
+            'artifact_cache_hit': self.artifact_cache_hit,
+            'artifacts': [str(item) for item in self.artifacts],
+            'binutils_version': self.binutils_version,
+            'ccache': self.ccache,
+            'compiler': str(self.compiler),
+            'compiler_version': self.compiler_version,
+            'cpu_time': self.cpu_time,
+            'filtered_problems': self.filtered_problems,
+            'make_cmd': self.make_cmd,
+            'max_rss_bytes': self.max_rss_bytes,
+            'out_dir': str(self.out_dir),
+            'phases': self.phases,
+            'problems': self.problems,
+            'returncode': self.returncode,
+            'rusage': self.rusage,
+            'wall_time': self.wall_time,
+        }
+
+
+def print_rusage(rusage):
+    cpu_time = rusage['user_time'] + rusage['system_time']
+    cpu_usage = cpu_time / rusage['wall_time'] if rusage['wall_time'] else 0
+    print(f"\nTime: {utils.get_duration(0, rusage['wall_time'])}")
+    print(f"User time: {rusage['user_time']:.2f}s")
+    print(f"System time: {rusage['system_time']:.2f}s")
+    print(f"CPU usage: {cpu_usage * 100:.0f}%")
+    print(f"Maximum resident set size: {rusage['max_rss_bytes'] // 1024**2} MiB")
+    print(f"Voluntary context switches: {rusage['voluntary_context_switches']}")
+    print(f"Involuntary context switches: {rusage['involuntary_context_switches']}")
+    print(f"Block input operations: {rusage['block_input_ops']}")
+    print(f"Block output operations: {rusage['block_output_ops']}")
+
+
+def kmake(variables,
+          targets,
+          ccache=True,
+          directory=None,
+          jobs=None,
+          silent=True,
+          use_time=False,
+          rusage_json=False,
+          ccache_partition=False,
+          ccache_size=None,
+          log_file=None,
+          trace_file=None,
+          artifact_cache=False,
+          artifact_cache_size='50G',
+          distcc_hosts=None,
+          check=True,
+          use_admission=False,
+          tmpfs=False,
+          tmpfs_folder='/dev/shm'):
     # Handle kernel directory right away
     if not (kernel_src := Path(directory) if directory else Path('.')).exists():
         raise RuntimeError(f"Derived kernel source ('{kernel_src}') does not exist?")
-    if not (makefile := Path(kernel_src, 'Makefile')).exists():
+    if not Path(kernel_src, 'Makefile').exists():
         raise RuntimeError(f"Derived kernel source ('{kernel_src}') is not a kernel tree?")
+    capabilities = get_tree_capabilities(kernel_src)
 
     # Get compiler related variables
     cc_str = variables.get('CC', '')
@@ -41,7 +552,7 @@ def kmake(variables, targets, ccache=True, directory=None, jobs=None, silent=Tru
         elif llvm:
             # We always want to check that the tree in question supports an
             # LLVM value other than 1
-            if 'LLVM_PREFIX' not in makefile.read_text(encoding='utf-8'):
+            if not capabilities['llvm_prefix']:
                 raise RuntimeError(
                     f"Derived kernel source ('{kernel_src}') does not support LLVM other than 1!")
             # We want to check that LLVM is a correct value but we do not want
@@ -64,13 +575,51 @@ def kmake(variables, targets, ccache=True, directory=None, jobs=None, silent=Tru
     # Ensure compiler is a Path object for the .parent use below
     compiler_location = (compiler := Path(compiler)).parent
 
+    compiler_info = probe_tool(compiler, compiler=True)
+
     # Handle ccache
+    env = None
+    ccache_stats = None
     if ccache:
         if shutil.which('ccache'):
             variables['CC'] = f"ccache {compiler}"
+            env = os.environ.copy()
+            if ccache_partition:
+                env['CCACHE_DIR'] = str(get_ccache_partition(compiler_info))
+                utils.print_green(f"\nccache directory:\033[0m {env['CCACHE_DIR']}\n")
+            if ccache_size:
+                env['CCACHE_MAXSIZE'] = ccache_size
+            ccache_stats = get_ccache_stats(env)
         else:
             utils.print_yellow('WARNING: ccache requested by it could not be found, ignoring...')
 
+    # Handle distcc, which has to be able to find the same compiler at the
+    # same location on each host. When ccache is used, it runs distcc itself
+    # on a cache miss.
+    distcc_slots = {}
+    if distcc_hosts:
+        if not shutil.which('distcc'):
+            raise RuntimeError('distcc requested but it could not be found?')
+        distcc_slots = get_distcc_slots(distcc_hosts)
+        if env is None:
+            env = os.environ.copy()
+        env['DISTCC_HOSTS'] = distcc_hosts
+        # Compile locally when a host fails, rather than failing the build
+        env['DISTCC_FALLBACK'] = '1'
+        if variables.get('CC', '').startswith('ccache '):
+            env['CCACHE_PREFIX'] = 'distcc'
+        else:
+            variables['CC'] = f"distcc {compiler}"
+        utils.print_green(f"\ndistcc hosts:\033[0m {distcc_hosts}\n")
+
+    # The phases of the build are figured out from Kbuild's quiet output and
+    # each compile is timed by wrapping CC
+    if trace_file:
+        silent = False
+        build_timeline = timeline.Timeline()
+    else:
+        build_timeline = None
+
     # V=1 or V=2 should imply '-v'
     if 'V' in variables:
         silent = False
@@ -78,16 +627,30 @@ def kmake(variables, targets, ccache=True, directory=None, jobs=None, silent=Tru
     flags = []
     if kernel_src.resolve() != Path.cwd().resolve():
         flags += ['-C', kernel_src]
-    flags += [f"-{'s' if silent else ''}kj{jobs if jobs else os.cpu_count()}"]
+    if not jobs:
+        jobs, reason = get_adaptive_jobs(cc_is_clang, get_out_dir(kernel_src, variables), targets)
+        # Compiles on other hosts do not use local CPUs or memory
+        if (remote_slots := sum(distcc_slots.values()) - distcc_slots.get('localhost', 0)):
+            jobs += remote_slots
+            reason += f", {remote_slots} distcc slots"
+        utils.print_green(f"\nJobs:\033[0m {jobs} ({reason})\n")
+    # Builds that share the machine through the admission daemon may get fewer
+    # jobs than they asked for, in exchange for not overcommitting it
+    lease = None
+    if use_admission:
+        lease = admission.acquire(jobs, f"kmake {' '.join(targets)}", min_slots=max(1, jobs // 4))
+        if lease.slots != jobs:
+            utils.print_green(f"\nJobs:\033[0m {lease.slots} (granted by admission daemon)\n")
+        jobs = lease.slots
+    flags += [f"-{'s' if silent else ''}kj{jobs}"]
 
     # Print information about current compiler
     utils.print_green(f"\nCompiler location:\033[0m {compiler_location}\n")
-    utils.print_green(f"Compiler version:\033[0m {get_tool_version(compiler)}\n")
+    utils.print_green(f"Compiler version:\033[0m {compiler_info['version']}\n")
 
     # Print information about the binutils being used, if they are being used
-    # Account for implicit LLVM_IAS change in f12b034afeb3 ("scripts/Makefile.clang: default to LLVM_IAS=1")
-    ias_def_on = Path(kernel_src, 'scripts/Makefile.clang').exists()
-    ias_def_val = 1 if cc_is_clang and ias_def_on else 0
+    binutils_version = None
+    ias_def_val = capabilities['llvm_ias_default'] if cc_is_clang else 0
     if int(variables.get('LLVM_IAS', ias_def_val)) == 0:
         if not (gnu_as := shutil.which(f"{cross_compile}as")):
             raise RuntimeError(
@@ -95,20 +658,147 @@ def kmake(variables, targets, ccache=True, directory=None, jobs=None, silent=Tru
         as_location = Path(gnu_as).parent
         if as_location != compiler_location:
             utils.print_green(f"Binutils location:\033[0m {as_location}\n")
-        utils.print_green(f"Binutils version:\033[0m {get_tool_version(gnu_as)}\n")
-
-    # Build and run make command
-    make_cmd = [
-        'stdbuf', '-eL', '-oL', 'make', *flags,
-        *[f"{key}={variables[key]}" for key in sorted(variables)], *targets
-    ]
-    if use_time:
-        if not (gnu_time := shutil.which('time')):
-            raise RuntimeError('Could not find time binary in PATH?')
-        make_cmd = [gnu_time, '-v'] + make_cmd
-    utils.print_cmd(make_cmd)
-    if not use_time:
-        start_time = time.time()
-    subprocess.run(make_cmd, check=True)
-    if not use_time:
-        print(f"\nTime: {utils.get_duration(start_time)}")
+        binutils_version = probe_tool(gnu_as)['version']
+        utils.print_green(f"Binutils version:\033[0m {binutils_version}\n")
+
+    # Only the artifacts are copied back from RAM, so the output of a build in
+    # RAM has to go somewhere other than the source folder
+    out_dir = get_out_dir(kernel_src, variables)
+    tmpfs_out_dir = None
+    compile_log = None
+    # The output folder in RAM, the log of compiles, and the job slots are
+    # given back even if the build fails or is interrupted
+    try:
+        if build_timeline:
+            compile_log_fd, compile_log = tempfile.mkstemp(prefix='kmake-compiles-',
+                                                           suffix='.jsonl')
+            os.close(compile_log_fd)
+            compile_log = Path(compile_log)
+            cc_wrapper = timeline.get_cc_wrapper(compile_log)
+            variables['CC'] = f"{cc_wrapper} {variables.get('CC', compiler)}"
+
+        if tmpfs:
+            if 'O' not in variables:
+                raise RuntimeError('Building in RAM requires an output folder (O=)!')
+            size_key = get_output_size_key(out_dir, variables, targets)
+            job_mem = jobs * get_job_mem_estimate(cc_is_clang, targets)
+            tmpfs_out_dir, reason = get_tmpfs_out_dir(tmpfs_folder, size_key, job_mem)
+            if tmpfs_out_dir:
+                utils.print_green(f"\nBuilding in RAM:\033[0m {tmpfs_out_dir} ({reason})\n")
+                if Path(out_dir, '.config').exists():
+                    shutil.copy2(Path(out_dir, '.config'), tmpfs_out_dir)
+                variables = {**variables, 'O': tmpfs_out_dir}
+            else:
+                utils.print_yellow(f"\nBuilding on disk: {reason}\n")
+
+        # Build and run make command
+        make_cmd = [
+            'stdbuf', '-eL', '-oL', 'make', *flags,
+            *[f"{key}={variables[key]}" for key in sorted(variables)]
+        ]
+
+        # The final configuration is part of the artifact cache key, so the
+        # configuration targets have to be run before the cache can be checked
+        build_dir = get_out_dir(kernel_src, variables)
+        cache_key = None
+        if artifact_cache:
+            if (config_targets := [target for target in targets if target.endswith('config')]):
+                utils.print_cmd(make_cmd + config_targets)
+                if (proc := subprocess.run(make_cmd + config_targets, check=False,
+                                           env=env)).returncode:
+                    raise subprocess.CalledProcessError(proc.returncode, proc.args)
+                targets = [target for target in targets if target not in config_targets]
+                # Only configuration targets were asked for, so there is nothing
+                # left to build or cache
+                if not targets:
+                    if tmpfs_out_dir:
+                        sync_tmpfs_build(tmpfs_out_dir, out_dir, ['.config'])
+                    result = BuildResult(compiler, compiler_info['version'], binutils_version,
+                                         make_cmd + config_targets, out_dir)
+                    result.returncode = 0
+                    return result
+            if targets and Path(build_dir, '.config').exists():
+                cache_key = artifacts.get_cache_key(kernel_src, build_dir, compiler_info, variables,
+                                                    targets)
+                if (restored := artifacts.restore(cache_key, out_dir)):
+                    utils.print_green(
+                        f"\nArtifact cache hit:\033[0m restored {len(restored)} files "
+                        f"from {cache_key[0:12]} into {out_dir}")
+                    result = BuildResult(compiler, compiler_info['version'], binutils_version,
+                                         make_cmd + targets, out_dir)
+                    result.artifact_cache_hit = True
+                    result.artifacts = [Path(out_dir, item) for item in restored]
+                    result.returncode = 0
+                    return result
+        make_cmd += targets
+        result = BuildResult(compiler, compiler_info['version'], binutils_version, make_cmd,
+                             out_dir)
+
+        problems = []
+        if log_file or build_timeline:
+            if log_file:
+                utils.print_green(f"Log file:\033[0m {log_file}\n")
+
+            def tee(stream):
+                if log_file:
+                    with open_log(log_file) as log:
+                        problems.extend(
+                            tee_output(stream, log, kernel_src.resolve(), build_timeline))
+                else:
+                    problems.extend(tee_output(stream, None, kernel_src.resolve(), build_timeline))
+        else:
+            tee = None
+        utils.print_cmd(make_cmd)
+        result.rusage = run_with_rusage(make_cmd, env=env, tee=tee)
+        if lease:
+            lease.release()
+        result.returncode = result.rusage['returncode']
+        if use_time:
+            print_rusage(result.rusage)
+        else:
+            print(f"\nTime: {utils.get_duration(0, result.wall_time)}")
+        if ccache_stats and (ccache_stats_after := get_ccache_stats(env)):
+            result.ccache = get_ccache_delta(ccache_stats, ccache_stats_after)
+            print_ccache_delta(result.ccache)
+        if log_file:
+            ignore_matcher = log_scan.get_ignore_matcher()
+            result.problems = problems
+            result.filtered_problems = [
+                item for item in problems if not ignore_matcher.search(item)
+            ]
+            print_problem_summary(result.problems, result.filtered_problems)
+        if build_timeline:
+            compiles = timeline.read_compiles(compile_log)
+            timeline.write_chrome_trace(trace_file, build_timeline, compiles)
+            timeline.print_timeline(build_timeline, compiles)
+            utils.print_green(f"\nTrace file:\033[0m {trace_file}")
+            result.phases = build_timeline.get_phase_durations()
+        built_artifacts = []
+        if not result.returncode:
+            built_artifacts = artifacts.get_artifacts(build_dir)
+            result.artifacts = [Path(out_dir, item) for item in built_artifacts]
+            if cache_key:
+                artifacts.store(cache_key, build_dir, artifacts.parse_size(artifact_cache_size))
+                result.artifact_cache_hit = False
+            if tmpfs:
+                record_output_size(size_key, get_dir_size(build_dir))
+        if tmpfs_out_dir:
+            # Keep the configuration of a failed build around to look at
+            sync_files = built_artifacts if not result.returncode else [
+                item for item in ['.config'] if Path(tmpfs_out_dir, item).exists()
+            ]
+            sync_tmpfs_build(tmpfs_out_dir, out_dir, sync_files)
+            utils.print_green(f"\nCopied {len(sync_files)} files from RAM to:\033[0m {out_dir}")
+        if rusage_json:
+            utils.write_json(Path(out_dir, 'kmake_rusage.json'), result.to_dict())
+        if check and result.returncode:
+            raise subprocess.CalledProcessError(result.returncode, make_cmd)
+
+        return result
+    finally:
+        if lease:
+            lease.release()
+        if tmpfs_out_dir:
+            shutil.rmtree(tmpfs_out_dir, ignore_errors=True)
+        if compile_log:
+            compile_log.unlink(missing_ok=True)
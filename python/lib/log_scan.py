@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2022-2023 Nathan Chancellor
+
+import hashlib
+import re
+
+# Logs are read this many bytes at a time
+CHUNK_SIZE = 1024 * 1024
+
+REGEX_METACHARACTERS = '.^$*+?{}[]()|\\'
+
+
+def problem_searches():
+    return [
+        'error:',
+        'Error:',
+        'ERROR:',
+        'FAILED:',
+        'FATAL:',
+        'undefined',
+        'Unsupported relocation type:',
+        'warning:',
+        'Warning:',
+        'WARNING:',
+    ]  # yapf: disable
+
+
+# Problems that are not a priority to fix
+def ignore_patterns():
+    merge_config_ignore = [
+        'CPU_BIG_ENDIAN',
+        'LTO_CLANG_THIN',
+        'SQUASHFS_DECOMP_SINGLE',
+        'SQUASHFS_DECOMP_MULTI',
+        'SQUASHFS_DECOMP_MULTI_PERCPU',
+    ]
+    return [
+        # Too many to deal with for now
+        'objtool:',
+        '-Wframe-larger-than',
+        # Warnings from merge_config that are harmless
+        f"override: ({'|'.join(merge_config_ignore)}) changes choice state",
+        # https://github.com/ClangBuiltLinux/linux/issues/1065
+        r'union jset::\(anonymous at ./usr/include/linux/bcache.h:',
+        # https://github.com/ClangBuiltLinux/linux/issues/1427
+        "llvm-objdump: error: 'vmlinux': not a dynamic object",
+        # https://github.com/ClangBuiltLinux/linux/issues/1315
+        "unused during compilation: '-march=arm",
+        # https://github.com/ClangBuiltLinux/linux/issues/1555
+        r"scripts/(extract-cert|sign-file).c:[0-9]+:[0-9]+: warning: '(ENGINE|ERR)_.*' is deprecated \[-Wdeprecated-declarations\]",
+        # New binutils warnings that are not clang specific:
+        # https://sourceware.org/bugzilla/show_bug.cgi?id=29072
+        'missing .note.GNU-stack section implies executable stack',
+        r'requires executable stack \(because the .note.GNU-stack section is executable\)',
+        'has a LOAD segment with RWX permissions',
+        # https://github.com/llvm/llvm-project/issues/59037
+        'error: write on a pipe with no reader',
+        # https://github.com/ClangBuiltLinux/linux/issues/1415
+        '(asmmacro.h|genex.S|[0-9]+):.*macro defined with named parameters',
+        'macro local_irq_enable reg=',
+        # new warning present with make 4.4:
+        # https://lore.kernel.org/Y7i8+EjwdnhHtlrr@dev-arch.thelio-3990X/
+        'llvm-nm: error: arch/arm/boot/compressed/../../../../vmlinux: No such file or directory',
+    ]
+
+
+def get_problem_re():
+    return re.compile('|'.join(problem_searches()))
+
+
+# The problem searches are plain strings, so they can be searched for in the
+# raw bytes of a log, which avoids decoding lines that are not interesting
+def get_problem_bytes_re():
+    return re.compile('|'.join(problem_searches()).encode('utf-8'))
+
+
+# Every problem search other than 'undefined' contains ':', which is rare in
+# Kbuild's quiet output, so only the lines that contain one of these tokens
+# can contain a problem. bytes.find() finds them much faster than running the
+# problem regular expression over every line.
+def get_prefilter_tokens():
+    return sorted({':' if ':' in search else search
+                   for search in problem_searches()})  # yapf: disable
+
+
+def get_ignore_re():
+    return re.compile('|'.join(ignore_patterns()))
+
+
+# The longest run of characters that every match of a pattern has to contain,
+# or None if there is no such run (for example, because of an alternation at
+# the top level). Characters inside of groups are never considered required.
+def get_required_literal(pattern):
+    runs = ['']
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\' and i + 1 < len(pattern):
+            literal = pattern[i + 1]
+            i += 2
+            # Escapes like \d, \s, and \b match classes of characters or
+            # positions, not the letter itself
+            if literal.isalnum():
+                runs.append('')
+                continue
+        elif char in REGEX_METACHARACTERS:
+            if char == '|' and depth == 0:
+                return None
+            # The character before a quantifier like these may not be there
+            if char in '*?{':
+                runs[-1] = runs[-1][:-1]
+            if char == '(':
+                depth += 1
+            elif char == ')':
+                depth -= 1
+            elif char == '[':
+                i = pattern.index(']', i + 2)
+            elif char == '{':
+                i = pattern.index('}', i)
+            runs.append('')
+            i += 1
+            continue
+        else:
+            literal = char
+            i += 1
+        if depth == 0:
+            runs[-1] += literal
+    return max(runs, key=len) or None
+
+
+# Checks text against a list of patterns, only running the regular expression
+# of a pattern when the text contains the literal that the pattern requires.
+# search() can be used in place of the search() of a combined regular
+# expression.
+class PrefilterMatcher:
+
+    def __init__(self, patterns):
+        self.patterns = [(get_required_literal(pattern), re.compile(pattern))
+                         for pattern in patterns]  # yapf: disable
+
+    def search(self, text):
+        for literal, regex in self.patterns:
+            if (literal is None or literal in text) and (match := regex.search(text)):
+                return match
+        return None
+
+
+def get_ignore_matcher():
+    return PrefilterMatcher(ignore_patterns())
+
+
+# Eliminating the source folder from the problems makes them easier to read
+# and allows them to be compared between trees
+def clean_line(line, src_folder):
+    return line.replace(f"{src_folder}/", '')
+
+
+# Offsets of the start and end of the lines that contain any of the tokens
+def get_candidate_lines(data, tokens):
+    lines = set()
+    for token in tokens:
+        pos = 0
+        while (index := data.find(token, pos)) != -1:
+            start = data.rfind(b'\n', 0, index) + 1
+            pos = data.find(b'\n', index) + 1 or len(data)
+            lines.add((start, pos))
+    return sorted(lines)
+
+
+def get_problem_lines(data, tokens, problem_bytes_re, problem_re):
+    for start, end in get_candidate_lines(data, tokens):
+        if not problem_bytes_re.search(data, start, end):
+            continue
+        # Compiler output is not always valid UTF-8. Line endings are
+        # translated like reading the log in text mode would, then lines are
+        # split the same way that str.splitlines() would split the whole log.
+        text = data[start:end].decode('utf-8', errors='replace')
+        for line in text.replace('\r\n', '\n').replace('\r', '\n').splitlines(keepends=True):
+            if problem_re.search(line):
+                yield line
+
+
+# Scans a log a chunk at a time. Only whole lines are searched, so the partial
+# line at the end of a chunk is carried over to the next one.
+class LogScanner:
+
+    def __init__(self):
+        self.tokens = [token.encode('utf-8') for token in get_prefilter_tokens()]
+        self.problem_bytes_re = get_problem_bytes_re()
+        self.problem_re = get_problem_re()
+        self.problems = set()
+        self.remainder = b''
+
+    # Returns the problems in data that have not been seen before
+    def feed(self, data):
+        data = self.remainder + data
+        end = data.rfind(b'\n') + 1
+        self.remainder = data[end:]
+        return self.add_problems(data[0:end])
+
+    # The last line of a finished log may not end with a newline
+    def finish(self):
+        data, self.remainder = self.remainder, b''
+        return self.add_problems(data)
+
+    def add_problems(self, data):
+        new = set(get_problem_lines(data, self.tokens, self.problem_bytes_re,
+                                    self.problem_re)) - self.problems
+        self.problems.update(new)
+        return new
+
+
+# Follows a log that is still being written, only reading what has been
+# appended since the last update
+class LogFollower(LogScanner):
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.offset = 0
+
+    def update(self):
+        # A log that shrank was started over
+        if (size := self.path.stat().st_size) < self.offset:
+            self.problems = set()
+            self.remainder = b''
+            self.offset = 0
+        if size == self.offset:
+            return set()
+        new = set()
+        with self.path.open('rb') as file:
+            file.seek(self.offset)
+            while (chunk := file.read(CHUNK_SIZE)):
+                self.offset += len(chunk)
+                new.update(self.feed(chunk))
+        return new
+
+
+# Stream a log in fixed size chunks so that memory usage does not depend on
+# the size of the log. The log is hashed while it is being read so that
+# callers can cache the result.
+def read_log_problems(path):
+    scanner = LogScanner()
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while (chunk := file.read(CHUNK_SIZE)):
+            sha256.update(chunk)
+            scanner.feed(chunk)
+    scanner.finish()
+    return scanner.problems, sha256.hexdigest()
+
+
+def scan_log(path, src_folder):
+    return {clean_line(line, src_folder) for line in read_log_problems(path)[0]}
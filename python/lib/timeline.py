@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2023 Nathan Chancellor
+
+import heapq
+import json
+from pathlib import Path
+import re
+import sys
+import time
+
+from . import utils
+
+# Lines from Kbuild's quiet output, such as '  CC      init/main.o'
+KBUILD_LINE_RE = re.compile(r'^  ([A-Z0-9_]+(?: \[M\])?) +(\S+)')
+
+
+# Figure out which phase of the build a line of output belongs to, based on
+# the command and the file that it is working on
+def classify_line(line):
+    if line.startswith('#') or 'configuration written to' in line:
+        return 'config'
+    if not (match := KBUILD_LINE_RE.match(line)):
+        return None
+    command, target = match.groups()
+    if 'scripts/kconfig/' in target or command == 'SYNC':
+        return 'config'
+    if command == 'MODPOST':
+        return 'modpost'
+    if target.startswith(('vmlinux', '.tmp_vmlinux', '.btf.vmlinux', '.vmlinux')):
+        return 'vmlinux link'
+    if target == 'System.map':
+        return 'vmlinux link'
+    if re.match('arch/[^/]+/boot/', target):
+        return 'boot image'
+    if '[M]' in command or target.endswith(('.ko', '.mod.o')):
+        return 'modules'
+    return 'compile'
+
+
+def get_cc_wrapper(compile_log):
+    wrapper = Path(__file__).resolve().parents[1].joinpath('scripts/kmake_cc_timer.py')
+    return f"{sys.executable} {wrapper} {compile_log}"
+
+
+class Timeline:
+    # Keep the compile tracks below the phase tracks
+    COMPILE_TID_BASE = 1000
+
+    def __init__(self):
+        self.start_ns = time.time_ns()
+        self.phases = {}
+
+    # Each phase spans from the first to the last line that belongs to it
+    def add_line(self, line):
+        if not (phase := classify_line(line)):
+            return
+        now = time.time_ns()
+        if phase in self.phases:
+            self.phases[phase][1] = now
+        else:
+            self.phases[phase] = [now, now]
+
+    def get_phase_durations(self):
+        return {phase: (end - start) / 1e9 for phase, (start, end) in self.phases.items()}
+
+    def to_us(self, timestamp_ns):
+        return (timestamp_ns - self.start_ns) / 1000
+
+    def get_trace_events(self, compiles):
+        events = []
+
+        # Phases can overlap (for example, modules are linked while vmlinux is
+        # being linked), so give each phase its own track
+        for tid, (phase, (start, end)) in enumerate(self.phases.items(), start=1):
+            events += [
+                {
+                    'args': {
+                        'name': f"Phase: {phase}"
+                    },
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': 1,
+                    'tid': tid,
+                },
+                {
+                    'cat': 'phase',
+                    'dur': (end - start) / 1000,
+                    'name': phase,
+                    'ph': 'X',
+                    'pid': 1,
+                    'tid': tid,
+                    'ts': self.to_us(start),
+                },
+            ]
+
+        # Pack the compiles into as few tracks as possible, as overlapping
+        # events on the same track are not displayed properly
+        lanes = []
+        for item in sorted(compiles, key=lambda item: item['start']):
+            if lanes and lanes[0][0] <= item['start']:
+                _, lane = heapq.heappop(lanes)
+            else:
+                lane = len(lanes) + 1
+                events.append({
+                    'args': {
+                        'name': f"Compile {lane}"
+                    },
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': 1,
+                    'tid': self.COMPILE_TID_BASE + lane,
+                })
+            heapq.heappush(lanes, (item['end'], lane))
+            events.append({
+                'cat': 'compile',
+                'dur': (item['end'] - item['start']) / 1000,
+                'name': item['output'],
+                'ph': 'X',
+                'pid': 1,
+                'tid': self.COMPILE_TID_BASE + lane,
+                'ts': self.to_us(item['start']),
+            })
+
+        return events
+
+
+def read_compiles(compile_log):
+    if not (compile_log := Path(compile_log)).exists():
+        return []
+    with compile_log.open(encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+# Chrome's trace event format, which can be loaded in Perfetto or
+# chrome://tracing
+def write_chrome_trace(trace_file, timeline, compiles):
+    utils.write_json(trace_file, {
+        'displayTimeUnit': 'ms',
+        'traceEvents': timeline.get_trace_events(compiles),
+    })
+
+
+def print_timeline(timeline, compiles, slowest=10):
+    utils.print_green('\nBuild phases:\033[0m')
+    for phase, duration in timeline.get_phase_durations().items():
+        print(f"    {phase}: {duration:.1f}s")
+
+    if compiles:
+        utils.print_green(f"\nSlowest {min(slowest, len(compiles))} compiles:\033[0m")
+        for item in sorted(compiles, key=lambda item: item['start'] - item['end'])[0:slowest]:
+            print(f"    {item['output']}: {(item['end'] - item['start']) / 1e9:.2f}s")
@@ -2,10 +2,25 @@
 # SPDX-License-Identifier: MIT
 # Copyright (C) 2022-2023 Nathan Chancellor
 
+import hashlib
+import json
+import os
 from pathlib import Path
 import shlex
+import tempfile
 import time
 
+# The umask can only be read by changing it, so that is done once up front
+# rather than while other threads might be creating files
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def get_cache_folder():
+    if 'XDG_CACHE_HOME' in os.environ:
+        return Path(os.environ['XDG_CACHE_HOME'], 'env')
+    return Path.home().joinpath('.cache/env')
+
 
 def get_duration(start_seconds, end_seconds=None):
     if not end_seconds:
@@ -33,6 +48,45 @@ def path_and_text(*args):
     return path, None
 
 
+# lib.sha256.calculate() requires requests, which scripts such as kmake.py
+# should not need
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with Path(path).open('rb') as file:
+        while (chunk := file.read(1048576)):  # 1MB at a time
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def read_json(path, default=None):
+    try:
+        return json.loads(Path(path).read_text(encoding='utf-8'))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {} if default is None else default
+
+
+# Files created by tempfile are only accessible by their owner, so give them
+# the mode that creating the file normally would have before moving them into
+# place
+def replace_file(tmp_path, path):
+    os.chmod(tmp_path, 0o666 & ~UMASK)
+    os.replace(tmp_path, path)
+
+
+# Write to a temporary file then rename it into place so that readers never
+# see a partially written file
+def write_json(path, data):
+    (path := Path(path)).parent.mkdir(exist_ok=True, parents=True)
+    with tempfile.NamedTemporaryFile('w',
+                                     delete=False,
+                                     dir=path.parent,
+                                     encoding='utf-8',
+                                     prefix=f".{path.name}.") as file:
+        json.dump(data, file, indent=4, sort_keys=True)
+        file.write('\n')
+    replace_file(file.name, path)
+
+
 def print_cmd(command):
     print(f"$ {' '.join([shlex.quote(str(elem)) for elem in command])}", flush=True)
 
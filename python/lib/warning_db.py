@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2023 Nathan Chancellor
+
+from pathlib import Path
+import re
+import sqlite3
+import time
+
+from . import utils
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    tree TEXT NOT NULL,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_tree_time ON runs (tree, time);
+
+CREATE TABLE IF NOT EXISTS builds (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    arch TEXT NOT NULL,
+    config TEXT NOT NULL,
+    toolchain TEXT NOT NULL,
+    PRIMARY KEY (run, arch, config, toolchain)
+);
+
+CREATE TABLE IF NOT EXISTS sightings (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    fingerprint TEXT NOT NULL,
+    arch TEXT NOT NULL,
+    config TEXT NOT NULL,
+    toolchain TEXT NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (run, fingerprint, arch, config, toolchain)
+);
+CREATE INDEX IF NOT EXISTS sightings_fingerprint ON sightings (fingerprint, run);
+
+CREATE TABLE IF NOT EXISTS warnings (
+    fingerprint TEXT PRIMARY KEY,
+    first_run INTEGER NOT NULL REFERENCES runs (id),
+    first_arch TEXT NOT NULL,
+    first_config TEXT NOT NULL,
+    first_toolchain TEXT NOT NULL,
+    last_run INTEGER NOT NULL REFERENCES runs (id),
+    last_arch TEXT NOT NULL,
+    last_config TEXT NOT NULL,
+    last_toolchain TEXT NOT NULL
+);
+'''
+
+# ':<line>:<column>:' or ':<line>:' after a file name, which changes whenever
+# code above a warning is added or removed
+LOCATION_RE = re.compile(r'(\.[A-Za-z0-9]+):[0-9]+(?::[0-9]+)?(?=:)')
+
+
+def get_default_database():
+    return Path(utils.get_cache_folder(), 'build_warnings.db')
+
+
+def connect(database):
+    Path(database).parent.mkdir(exist_ok=True, parents=True)
+    conn = sqlite3.connect(database)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+# Warnings are expected to have had the source folder removed already
+def get_fingerprint(warning):
+    return LOCATION_RE.sub(r'\1', warning.strip())
+
+
+# Add or replace the warnings of a run. builds is a dictionary of
+# (arch, config, toolchain) tuples to a list of warnings, which should include
+# builds without any warnings so that warnings that went away are noticed.
+# run_time is when the builds happened (default: now), which is what runs are
+# ordered by, as the report of an older run can be regenerated at any point.
+# Runs with the same time are ordered by when they were first recorded.
+def record_run(conn, name, tree, builds, run_time=None):
+    run_time = run_time or time.time()
+    with conn:
+        if (row := conn.execute('SELECT id FROM runs WHERE name = ?', (name, )).fetchone()):
+            run = row[0]
+            # Regenerating a report replaces what was recorded for the run
+            conn.execute('UPDATE runs SET tree = ?, time = ? WHERE id = ?', (tree, run_time, run))
+            conn.execute('DELETE FROM builds WHERE run = ?', (run, ))
+            conn.execute('DELETE FROM sightings WHERE run = ?', (run, ))
+        else:
+            run = conn.execute('INSERT INTO runs (name, tree, time) VALUES (?, ?, ?)',
+                               (name, tree, run_time)).lastrowid
+
+        conn.executemany('INSERT INTO builds VALUES (?, ?, ?, ?)',
+                         [(run, *build) for build in builds])
+        sightings = {}
+        for build, warnings in builds.items():
+            for warning in warnings:
+                sightings[(get_fingerprint(warning), *build)] = warning
+        conn.executemany('INSERT INTO sightings VALUES (?, ?, ?, ?, ?, ?)',
+                         [(run, *key, text) for key, text in sightings.items()])
+        conn.executemany(
+            '''
+            INSERT INTO warnings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (fingerprint) DO UPDATE SET
+                last_run = excluded.last_run,
+                last_arch = excluded.last_arch,
+                last_config = excluded.last_config,
+                last_toolchain = excluded.last_toolchain
+            WHERE (SELECT time, id FROM runs WHERE id = excluded.last_run)
+                >= (SELECT time, id FROM runs WHERE id = warnings.last_run)
+            ''', [(key[0], run, *key[1:], run, *key[1:]) for key in sorted(sightings)])
+        # The run may have happened before the first run a warning was seen in
+        conn.executemany(
+            '''
+            UPDATE warnings SET
+                first_run = ?,
+                first_arch = ?,
+                first_config = ?,
+                first_toolchain = ?
+            WHERE fingerprint = ? AND (SELECT time, id FROM runs WHERE id = ?)
+                < (SELECT time, id FROM runs WHERE id = warnings.first_run)
+            ''', [(run, *key[1:], key[0], run) for key in sorted(sightings)])
+
+    return run
+
+
+def get_previous_run(conn, run):
+    return conn.execute(
+        '''
+        SELECT id, name FROM runs
+        WHERE tree = (SELECT tree FROM runs WHERE id = ?)
+            AND (time, id) < (SELECT time, id FROM runs WHERE id = ?)
+        ORDER BY time DESC, id DESC LIMIT 1
+        ''', (run, run)).fetchone()
+
+
+# Compare the warnings of a run against the previous run of the same tree.
+# Only builds that happened in both runs are compared, so that a build that
+# failed or was skipped does not make its warnings look fixed. Returns a
+# dictionary of 'new', 'fixed' and 'still present' to sorted lists of
+# (arch, config, toolchain, fingerprint, text) tuples.
+def compare_runs(conn, run, previous_run):
+    query = '''
+        SELECT s.arch, s.config, s.toolchain, s.fingerprint, s.text FROM sightings AS s
+        JOIN builds AS b ON b.run = ? AND b.arch = s.arch AND b.config = s.config
+            AND b.toolchain = s.toolchain
+        WHERE s.run = ? AND {} EXISTS (
+            SELECT 1 FROM sightings AS o WHERE o.run = ? AND o.fingerprint = s.fingerprint
+                AND o.arch = s.arch AND o.config = s.config AND o.toolchain = s.toolchain
+        )
+        ORDER BY s.arch, s.config, s.toolchain, s.fingerprint
+    '''
+    current = (previous_run, run, previous_run)
+    return {
+        'new': conn.execute(query.format('NOT'), current).fetchall(),
+        'fixed': conn.execute(query.format('NOT'), (run, previous_run, run)).fetchall(),
+        'still present': conn.execute(query.format(''), current).fetchall(),
+    }
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2023 Nathan Chancellor
+# Description: Hand out job slots to builds running on the same machine so
+# that they do not all assume that they own every CPU.
+
+from argparse import ArgumentParser
+import itertools
+import json
+import os
+from pathlib import Path
+import select
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+# pylint: disable=wrong-import-position
+import lib.admission  # noqa: E402
+import lib.utils  # noqa: E402
+# pylint: enable=wrong-import-position
+
+
+class Admission:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.cond = threading.Condition()
+        self.ids = itertools.count(1)
+        self.leases = {}
+        self.queue = []
+
+    def get_free(self):
+        return self.capacity - sum(lease['slots'] for lease in self.leases.values())
+
+    # Requests are served in order so that a large request is not starved by
+    # a stream of smaller ones
+    def can_grant(self, request):
+        return self.queue[0] is request and self.get_free() >= request['min_slots']
+
+    def get_status(self):
+        with self.cond:
+            return {
+                'capacity': self.capacity,
+                'free': self.get_free(),
+                'leases': list(self.leases.values()),
+                'queue': list(self.queue),
+            }
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def send(self, message):
+        self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+
+    # A client that disconnects while it is queued no longer wants its slots
+    def client_gone(self):
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        return readable and not self.connection.recv(1, socket.MSG_PEEK)
+
+    def acquire(self, request):
+        admission = self.server.admission
+        request.update(id=next(admission.ids), since=time.time())
+        # A request can never be bigger than the machine
+        request['min_slots'] = min(request['min_slots'], admission.capacity)
+
+        with admission.cond:
+            admission.queue.append(request)
+            if not admission.can_grant(request):
+                self.send({
+                    'capacity': admission.capacity,
+                    'free': admission.get_free(),
+                    'queued': admission.queue.index(request),
+                })
+            while not admission.can_grant(request):
+                admission.cond.wait(timeout=1)
+                if self.client_gone():
+                    admission.queue.remove(request)
+                    admission.cond.notify_all()
+                    return
+            admission.queue.remove(request)
+            request.update(since=time.time(), slots=min(request['slots'], admission.get_free()))
+            admission.leases[request['id']] = request
+            admission.cond.notify_all()
+
+        try:
+            self.send({'granted': request['slots']})
+            # The lease is held until the client closes the connection
+            while self.rfile.read(4096):
+                pass
+        finally:
+            with admission.cond:
+                del admission.leases[request['id']]
+                admission.cond.notify_all()
+
+    def handle(self):
+        if not (line := self.rfile.readline()):
+            return
+        request = json.loads(line)
+        if request['cmd'] == 'acquire':
+            self.acquire(request)
+        elif request['cmd'] == 'status':
+            self.send(self.server.admission.get_status())
+        else:
+            self.send({'error': f"Unknown command ('{request['cmd']}')"})
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, admission):
+        self.admission = admission
+        super().__init__(str(socket_path), RequestHandler)
+
+
+def serve(socket_path, slots):
+    if socket_path.exists():
+        try:
+            lib.admission.get_status(socket_path)
+        except OSError:
+            # Left behind by a daemon that did not exit cleanly
+            socket_path.unlink()
+        else:
+            raise RuntimeError(f"Build admission daemon already running on {socket_path}?")
+
+    with Server(socket_path, Admission(slots)) as server:
+        # Builds from other users and containers may connect as well
+        socket_path.chmod(0o666)
+        lib.utils.print_green(f"Handing out {slots} job slots on {socket_path}")
+        # Clean up the socket when stopped by a service manager as well
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            socket_path.unlink()
+
+
+def show_status(socket_path, print_json):
+    status = lib.admission.get_status(socket_path)
+    if print_json:
+        print(json.dumps(status, indent=4, sort_keys=True))
+        return
+
+    print(f"Job slots: {status['capacity'] - status['free']} of {status['capacity']} in use")
+    print(f"Queue depth: {len(status['queue'])}")
+    if status['leases']:
+        lib.utils.print_green('\nLeases:')
+        for lease in status['leases']:
+            print(f"    {lease['name']} ({lease['user']}, pid {lease['pid']}): "
+                  f"{lease['slots']} slots for {lib.utils.get_duration(lease['since'])}")
+    if status['queue']:
+        lib.utils.print_yellow('\nQueue:')
+        for position, request in enumerate(status['queue'], start=1):
+            print(f"    {position}. {request['name']} ({request['user']}, pid {request['pid']}): "
+                  f"wants {request['slots']} slots (at least {request['min_slots']}), "
+                  f"waiting for {lib.utils.get_duration(request['since'])}")
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Hand out job slots to builds running on this machine')
+    parser.add_argument('-S',
+                        '--socket',
+                        default=lib.admission.get_socket_path(),
+                        help='Path to the socket of the daemon (default: %(default)s)',
+                        type=Path)
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='Run the daemon')
+    serve_parser.add_argument('-s',
+                              '--slots',
+                              default=os.cpu_count(),
+                              help='Number of job slots to hand out (default: %(default)s)',
+                              type=int)
+
+    status_parser = subparsers.add_parser('status', help='Show the leases and queue of the daemon')
+    status_parser.add_argument('--json', action='store_true', help='Print the raw status as JSON')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.subcommand == 'serve':
+        serve(args.socket, args.slots)
+    elif args.subcommand == 'status':
+        show_status(args.socket, args.json)
@@ -3,12 +3,14 @@
 # Copyright (C) 2022-2023 Nathan Chancellor
 
 from argparse import ArgumentParser
+import json
 import os
 from pathlib import Path
 import platform
 import shutil
 import subprocess
 import sys
+import time
 
 import requests
 
@@ -17,6 +19,7 @@ import korg_gcc
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 # pylint: disable=wrong-import-position
 import lib.kernel  # noqa: E402
+import lib.utils  # noqa: E402
 # pylint: enable=wrong-import-position
 
 
@@ -85,6 +88,12 @@ def parse_arguments():
                         default='llvm',
                         help='Toolchain to build kernel with')
 
+    parser.add_argument('-r',
+                        '--results-file',
+                        default=Path(lib.utils.get_cache_folder(), 'cbl_bld_krnl_for_vm.jsonl'),
+                        help='File to append the result of the build to (default: %(default)s)',
+                        type=Path)
+
     parser.add_argument('--additional-targets',
                         action='append',
                         help="Call target before 'all' target")
@@ -143,7 +152,26 @@ def build_kernel_for_vm(add_make_targets, make_variables, config, menuconfig, vm
     if add_make_targets:
         for target in add_make_targets:
             make_targets.insert(-1, target)
-    lib.kernel.kmake(make_variables, make_targets)
+    return lib.kernel.kmake(make_variables, make_targets)
+
+
+# Keep a record of each build so that build performance can be compared over
+# time and between toolchains
+def save_result(results_file, build_result, vm_name, toolchain):
+    kernel_commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                   capture_output=True,
+                                   check=True,
+                                   text=True).stdout.strip()
+    record = {
+        'kernel_commit': kernel_commit,
+        'time': time.time(),
+        'toolchain': toolchain,
+        'vm_name': vm_name,
+        **build_result.to_dict(),
+    }
+    results_file.parent.mkdir(exist_ok=True, parents=True)
+    with results_file.open('a', encoding='utf-8') as file:
+        file.write(json.dumps(record, sort_keys=True) + '\n')
 
 
 if __name__ == '__main__':
@@ -165,8 +193,20 @@ if __name__ == '__main__':
         'LSMOD': lsmod,
         'O': Path('build'),
     }
+    capabilities = lib.kernel.get_tree_capabilities('.')
+    if lib.kernel.get_srcarch(make_vars['ARCH']) not in capabilities['arches']:
+        raise RuntimeError(
+            f"Kernel tree ({capabilities['version']}) does not support ARCH={make_vars['ARCH']}?")
+    # Catch a typo in a configuration target before the tree is cleaned
+    config_targets = lib.kernel.get_config_targets(capabilities, make_vars['ARCH'])
+    for make_target in args.additional_targets or []:
+        if make_target.endswith('config') and make_target not in config_targets:
+            raise RuntimeError(
+                f"Kernel tree ({capabilities['version']}) does not have a '{make_target}' target?")
+
     make_vars.update(get_toolchain_vars(make_vars['ARCH'], args.toolchain))
     make_vars.update(dict(arg.split('=', 1) for arg in args.make_args))
 
-    build_kernel_for_vm(args.additional_targets, make_vars, args.config, args.menuconfig,
-                        args.vm_name)
+    result = build_kernel_for_vm(args.additional_targets, make_vars, args.config, args.menuconfig,
+                                 args.vm_name)
+    save_result(args.results_file, result, args.vm_name, args.toolchain)
@@ -3,19 +3,73 @@
 # Copyright (C) 2022-2023 Nathan Chancellor
 
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
 from pathlib import Path
 import re
 import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+# pylint: disable=wrong-import-position
+import lib.file_watch  # noqa: E402
+import lib.log_scan  # noqa: E402
+import lib.utils  # noqa: E402
+import lib.warning_db  # noqa: E402
+# pylint: enable=wrong-import-position
+
+# Problems found in each log, so that only new or modified logs have to be
+# scanned when the report is generated again
+SCAN_CACHE = '.report_cache.json'
+# Bumped when the scanner finds different problems in the same log
+SCAN_CACHE_VERSION = 2
 
 
 def parse_arguments():
     parser = ArgumentParser(
         description='Prepare an email build report from build logs generated with cbl_lkt')
 
+    parser.add_argument(
+        '-d',
+        '--database',
+        default=lib.warning_db.get_default_database(),
+        help='Database to compare warnings against previous runs with (default: %(default)s)')
+    parser.add_argument(
+        '--interval',
+        default=5,
+        help='Minimum seconds between report updates with --watch (default: %(default)s)',
+        type=float)
+    parser.add_argument('-n',
+                        '--no-database',
+                        action='store_true',
+                        help='Do not record warnings in or compare against the warning database')
+    parser.add_argument('-j',
+                        '--jobs',
+                        default=os.cpu_count(),
+                        help='Number of logs to scan at the same time (default: %(default)s)',
+                        type=int)
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Also write the report as JSON to report.json (with -p, print JSON instead of text)')
     parser.add_argument('-p',
                         '--print-to-stdout',
                         action='store_true',
                         help='Print to stdout instead of writing to report.txt in log folder')
+    parser.add_argument('--run',
+                        help='Name of this run in the warning database (default: log folder name)')
+    parser.add_argument('-r',
+                        '--rescan',
+                        action='store_true',
+                        help=f"Scan every log, even if {SCAN_CACHE} says it has not changed")
+    parser.add_argument(
+        '-w',
+        '--watch',
+        action='store_true',
+        help='Follow the logs while they are being written and keep the report up to date')
     parser.add_argument('folder', type=str, help='Path to build logs')
 
     return parser.parse_args()
@@ -30,74 +84,96 @@ def git_get(repo, cmd):
                           text=True).stdout
 
 
-def generate_warnings(log_folder, src_folder):
-    # Get full list of logs from folder, excluding internal logs for filtering sake
+def get_log_stamp(log):
+    stat = log.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# A log whose size and modification time have changed may still have the
+# same contents (for example, when a folder of logs is copied), which the hash
+# catches before falling back to scanning it again.
+def get_cached_problems(log, cache):
+    if not (entry := cache.get(log.name)):
+        return None
+    if entry['stamp'] != (stamp := get_log_stamp(log)):
+        if entry['sha256'] != lib.utils.hash_file(log):
+            return None
+        entry['stamp'] = stamp
+    return entry['problems']
+
+
+def scan_logs(log_folder, logs, jobs, rescan):
+    # The cache is only valid for the scanner and problem searches that
+    # created it
+    cache_file = Path(log_folder, SCAN_CACHE)
+    cache = {} if rescan else lib.utils.read_json(cache_file)
+    if (cache.get('version') != SCAN_CACHE_VERSION
+            or cache.get('problem_searches') != lib.log_scan.problem_searches()):
+        cache = {}
+    cached_logs = cache.get('logs', {})
+
+    problems = {}
+    for log in logs:
+        if (cached := get_cached_problems(log, cached_logs)) is not None:
+            problems[log.name] = cached
+
+    # Each log is independent, so they can be scanned in separate processes;
+    # map() returns the results in the order of the logs, so the report does
+    # not depend on which scan finishes first.
+    to_scan = [log for log in logs if log.name not in problems]
+    if (jobs := min(jobs, len(to_scan))) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(lib.log_scan.read_log_problems, to_scan))
+    else:
+        results = [lib.log_scan.read_log_problems(log) for log in to_scan]
+    for log, (log_problems, sha256) in zip(to_scan, results):
+        problems[log.name] = sorted(log_problems)
+        cached_logs[log.name] = {
+            'problems': problems[log.name],
+            'sha256': sha256,
+            'stamp': get_log_stamp(log),
+        }
+
+    cache['logs'] = {log.name: cached_logs[log.name] for log in logs}
+    cache['problem_searches'] = lib.log_scan.problem_searches()
+    cache['version'] = SCAN_CACHE_VERSION
+    lib.utils.write_json(cache_file, cache)
+
+    return {log.name: problems[log.name] for log in logs}
+
+
+# Get full list of logs from folder, excluding internal logs for filtering sake.
+# Hidden files are the scan cache and reports that are still being written.
+def get_build_logs(log_folder):
     internal_files = {elem + '.log' for elem in ['failed', 'info', 'skipped', 'success']}
-    internal_files.add('report.txt')
-    logs = sorted([elem for elem in log_folder.iterdir() if elem.name not in internal_files])
-
-    # Generate a full list of warnings across all builds, deduplicated per build
-    searches = [
-        'error:',
-        'Error:',
-        'ERROR:',
-        'FAILED:',
-        'FATAL:',
-        'undefined',
-        'Unsupported relocation type:',
-        'warning:',
-        'Warning:',
-        'WARNING:',
-    ]  # yapf: disable
-    prob_re = re.compile('|'.join(searches))
+    internal_files.update(['report.json', 'report.txt'])
+    return sorted([
+        elem for elem in log_folder.iterdir()
+        if elem.name not in internal_files and not elem.name.startswith('.')
+    ])
+
+
+# log_problems can be passed in by callers that already have the problems of
+# each log (in the order of the logs), such as when following the logs as they
+# are written
+def generate_warnings(log_folder, src_folder, jobs=1, rescan=False, log_problems=None):
+    logs = get_build_logs(log_folder)
+    if log_problems is None:
+        log_problems = scan_logs(log_folder, logs, jobs, rescan)
+
+    # Generate a full list of warnings across all builds, deduplicated per
+    # build. The ignore list is applied below, so changing it does not require
+    # scanning the logs again.
     warnings = {}
-    for log in logs:
-        lines = log.read_text(encoding='utf-8').splitlines(keepends=True)
-        warnings[log.name] = sorted(
-            {line.replace(f"{src_folder}/", '')
-             for line in lines if prob_re.search(line)})
+    for log, problems in log_problems.items():
+        warnings[log] = sorted({lib.log_scan.clean_line(line, src_folder) for line in problems})
     full = {key: value for key, value in warnings.items() if value}
 
     # Filter warnings based on priority to fix
-    merge_config_ignore = [
-        'CPU_BIG_ENDIAN',
-        'LTO_CLANG_THIN',
-        'SQUASHFS_DECOMP_SINGLE',
-        'SQUASHFS_DECOMP_MULTI',
-        'SQUASHFS_DECOMP_MULTI_PERCPU',
-    ]
-    ignore = [
-        # Too many to deal with for now
-        'objtool:',
-        '-Wframe-larger-than',
-        # Warnings from merge_config that are harmless
-        f"override: ({'|'.join(merge_config_ignore)}) changes choice state",
-        # https://github.com/ClangBuiltLinux/linux/issues/1065
-        r'union jset::\(anonymous at ./usr/include/linux/bcache.h:',
-        # https://github.com/ClangBuiltLinux/linux/issues/1427
-        "llvm-objdump: error: 'vmlinux': not a dynamic object",
-        # https://github.com/ClangBuiltLinux/linux/issues/1315
-        "unused during compilation: '-march=arm",
-        # https://github.com/ClangBuiltLinux/linux/issues/1555
-        r"scripts/(extract-cert|sign-file).c:[0-9]+:[0-9]+: warning: '(ENGINE|ERR)_.*' is deprecated \[-Wdeprecated-declarations\]",
-        # New binutils warnings that are not clang specific:
-        # https://sourceware.org/bugzilla/show_bug.cgi?id=29072
-        'missing .note.GNU-stack section implies executable stack',
-        r'requires executable stack \(because the .note.GNU-stack section is executable\)',
-        'has a LOAD segment with RWX permissions',
-        # https://github.com/llvm/llvm-project/issues/59037
-        'error: write on a pipe with no reader',
-        # https://github.com/ClangBuiltLinux/linux/issues/1415
-        '(asmmacro.h|genex.S|[0-9]+):.*macro defined with named parameters',
-        'macro local_irq_enable reg=',
-        # new warning present with make 4.4:
-        # https://lore.kernel.org/Y7i8+EjwdnhHtlrr@dev-arch.thelio-3990X/
-        'llvm-nm: error: arch/arm/boot/compressed/../../../../vmlinux: No such file or directory',
-    ]
-    ignore_re = re.compile('|'.join(ignore))
+    ignore_matcher = lib.log_scan.get_ignore_matcher()
     warnings = {}
     for log, problems in full.items():
-        warnings[log] = sorted({item for item in problems if not ignore_re.search(item)})
+        warnings[log] = sorted({item for item in problems if not ignore_matcher.search(item)})
     filtered = {key: value for key, value in warnings.items() if value}
 
     # Deduplicate warnings across all builds
@@ -106,16 +182,91 @@ def generate_warnings(log_folder, src_folder):
     return full, filtered, unique
 
 
-def generate_report(log_folder):
+# Logs are normally named '<arch>-<config>.log' and the toolchain is the same
+# for every build in a run. Logs without a configuration have an empty one.
+def get_build(log_name, toolchain):
+    arch, _, config = log_name.removesuffix('.log').partition('-')
+    return arch, config, toolchain
+
+
+def get_log_name(arch, config):
+    return f"{arch}-{config}.log" if config else f"{arch}.log"
+
+
+def get_toolchain(info_text):
+    if (match := re.search(r'^((?:clang|gcc|GCC).* version \S+)', info_text, flags=re.M)):
+        return match.groups()[0]
+    return 'unknown'
+
+
+# Record the warnings of this run in the database and compare them against
+# the previous run of the same tree
+def compare_warnings(database, run_name, src_folder, info_text, log_folder, full):
+    toolchain = get_toolchain(info_text)
+    builds = {
+        get_build(log.name, toolchain): full.get(log.name, [])
+        for log in get_build_logs(log_folder)
+    }
+
+    conn = lib.warning_db.connect(database)
+    try:
+        # The builds happened when info.log was last written, not now, as the
+        # report of an older run can be regenerated
+        run_time = get_log(log_folder, 'info').stat().st_mtime
+        run = lib.warning_db.record_run(conn, run_name, src_folder.name, builds, run_time)
+        if not (previous_run := lib.warning_db.get_previous_run(conn, run)):
+            return None, None
+        changes = lib.warning_db.compare_runs(conn, run, previous_run[0])
+    finally:
+        conn.close()
+
+    # Warnings are compared regardless of the ignore list so that changing it
+    # does not change what was recorded
+    ignore_matcher = lib.log_scan.get_ignore_matcher()
+    changes = {
+        section: [item for item in items if not ignore_matcher.search(item[-1])]
+        for section, items in changes.items()
+    }
+    return previous_run[1], changes
+
+
+def get_commit_logs(src_folder):
+    if not (mfc := git_get(src_folder, ['mfc']).strip()):
+        return None
+    branch = git_get(src_folder, ['bn']).strip()
+    if (remote := git_get(src_folder, ['rn', branch]).strip()):
+        since = f"{remote}/{branch}"
+    else:
+        since = f"{mfc}^"
+    return git_get(src_folder, ['l', f"{since}^.."])
+
+
+def read_optional_log(log_folder, key):
+    if (log := get_log(log_folder, key)).exists():
+        return log.read_text(encoding='utf-8')
+    return None
+
+
+def get_src_folder(info_text):
+    if (match := re.search('^Linux source location: (.*)$', info_text, flags=re.M)):
+        return Path(match.groups()[0])
+    return None
+
+
+def generate_report(log_folder,
+                    jobs=1,
+                    rescan=False,
+                    database=None,
+                    run_name=None,
+                    log_problems=None):
     # First, we need to figure out the source directory, so we can eliminate
     # its path from all the warnings, which makes the report a little easier to
     # read.
     if not (info_log := get_log(log_folder, 'info')).exists():
         raise RuntimeError('info.log does not exist?')
     info_text = info_log.read_text(encoding='utf-8')
-    if not (match := re.search('^Linux source location: (.*)$', info_text, flags=re.M)):
+    if not (src_folder := get_src_folder(info_text)):
         raise RuntimeError('Could not figure out source folder?')
-    src_folder = Path(match.groups()[0])
 
     # Next, generate three items:
     # * full: A dictionary of lists, with the log name as the key and a sorted
@@ -125,51 +276,153 @@ def generate_report(log_folder):
     # * unique: A sorted list of unique warnings across the series of builds
     #           (so warnings seen in multiple builds are only seen once in the
     #           list).
-    full, filtered, unique = generate_warnings(log_folder, src_folder)
+    full, filtered, unique = generate_warnings(log_folder, src_folder, jobs, rescan, log_problems)
+
+    report = {
+        'changes': None,
+        'commit_logs': get_commit_logs(src_folder) if src_folder.exists() else None,
+        'failed': read_optional_log(log_folder, 'failed'),
+        'filtered': filtered,
+        'full': full,
+        'info': info_text,
+        'previous_run': None,
+        'skipped': read_optional_log(log_folder, 'skipped'),
+        'src_folder': str(src_folder),
+        'success': read_optional_log(log_folder, 'success'),
+        'unique': unique,
+    }
+
+    if database:
+        previous_run, changes = compare_warnings(database, run_name or log_folder.name, src_folder,
+                                                 info_text, log_folder, full)
+        if changes:
+            keys = ['arch', 'config', 'toolchain', 'fingerprint', 'text']
+            report['changes'] = {
+                section: [dict(zip(keys, item)) for item in items]
+                for section, items in changes.items()
+            }
+            report['previous_run'] = previous_run
 
-    # Build report text based on log files and filtered warnings above.
-    report_text = info_text
+    return report
 
-    if (failed_log := get_log(log_folder, 'failed')).exists():
-        report_text += '\nList of failed tests:\n\n'
-        report_text += failed_log.read_text(encoding='utf-8')
 
-    if (skipped_log := get_log(log_folder, 'skipped')).exists():
-        report_text += '\nList of skipped tests:\n\n'
-        report_text += skipped_log.read_text(encoding='utf-8')
+# The report is written piece by piece rather than built up as one string,
+# as there can be tens of thousands of warnings
+def write_text_report(file, report):
+    file.write(report['info'])
 
-    if unique:
-        report_text += '\nUnique warning report:\n\n'
-        for warning in unique:
-            report_text += warning
+    if report['failed'] is not None:
+        file.write('\nList of failed tests:\n\n')
+        file.write(report['failed'])
 
-    if filtered:
-        report_text += '\nFiltered warning report:\n\n'
-        for log, warnings in filtered.items():
-            for warning in warnings:
-                report_text += f"{log}:{warning}"
+    if report['skipped'] is not None:
+        file.write('\nList of skipped tests:\n\n')
+        file.write(report['skipped'])
 
-    report_text += '\nList of successful tests:\n\n'
-    report_text += get_log(log_folder, 'success').read_text(encoding='utf-8')
+    if report['unique']:
+        file.write('\nUnique warning report:\n\n')
+        file.writelines(report['unique'])
 
-    if full:
-        report_text += '\nFull warning report:\n\n'
-        for log, warnings in full.items():
-            for warning in warnings:
-                report_text += f"{log}:{warning}"
+    if report['filtered']:
+        file.write('\nFiltered warning report:\n\n')
+        for log, warnings in report['filtered'].items():
+            file.writelines(f"{log}:{warning}" for warning in warnings)
 
-    if src_folder.exists():
-        mfc = git_get(src_folder, ['mfc']).strip()
-        if mfc:
-            report_text += f"\n{src_folder.name} commit logs:\n\n"
-            branch = git_get(src_folder, ['bn']).strip()
-            if (remote := git_get(src_folder, ['rn', branch]).strip()):
-                since = f"{remote}/{branch}"
-            else:
-                since = f"{mfc}^"
-            report_text += git_get(src_folder, ['l', f"{since}^.."])
+    for section, items in (report['changes'] or {}).items():
+        if items:
+            file.write(
+                f"\n{section.capitalize()} warnings compared to {report['previous_run']}:\n\n")
+            file.writelines(f"{get_log_name(item['arch'], item['config'])}:{item['text']}"
+                            for item in items)
 
-    return report_text
+    # success.log does not exist until the run is done when watching the logs
+    file.write('\nList of successful tests:\n\n')
+    file.write(report['success'] or '')
+
+    if report['full']:
+        file.write('\nFull warning report:\n\n')
+        for log, warnings in report['full'].items():
+            file.writelines(f"{log}:{warning}" for warning in warnings)
+
+    if report['commit_logs']:
+        file.write(f"\n{Path(report['src_folder']).name} commit logs:\n\n")
+        file.write(report['commit_logs'])
+
+
+# Replace the reports in one step so that they are never seen half written
+def write_reports(log_folder, report, write_json):
+    with tempfile.NamedTemporaryFile('w',
+                                     delete=False,
+                                     dir=log_folder,
+                                     encoding='utf-8',
+                                     prefix='.report.txt.') as file:
+        write_text_report(file, report)
+    lib.utils.replace_file(file.name, Path(log_folder, 'report.txt'))
+    if write_json:
+        lib.utils.write_json(Path(log_folder, 'report.json'), report)
+
+
+# The sizes and modification times of the files that a report is generated
+# from. The reports and temporary files are written to the same folder, so
+# they are left out to avoid regenerating the reports because of themselves.
+def get_input_state(log_folder):
+    state = {}
+    for item in log_folder.iterdir():
+        if not item.name.startswith(('.', 'report.')):
+            stat = item.stat()
+            state[item.name] = (stat.st_size, stat.st_mtime_ns)
+    return state
+
+
+# Follow the logs of a run that is still going, only scanning what has been
+# appended to each log since it was last looked at. New warnings are printed
+# as they show up and the reports are regenerated at most every interval
+# seconds. The warning database is only updated once the run is stopped, as
+# the warnings of a run that is still going are incomplete.
+def watch(log_folder, interval, write_json):
+    lib.utils.print_green(f"Watching {log_folder}, press Ctrl-C to stop...")
+    ignore_matcher = lib.log_scan.get_ignore_matcher()
+    followers = {}
+    watcher = lib.file_watch.get_watcher(log_folder)
+    last_write = 0
+    input_state = None
+    src_folder = None
+    changed = False
+    try:
+        while True:
+            # Before the logs are read so that nothing written in between is missed
+            if (new_state := get_input_state(log_folder)) != input_state:
+                input_state = new_state
+                changed = True
+
+            # info.log is written at the start of the run, so wait for it to
+            # say where the source is, which is left out of the warnings
+            if not src_folder and (info_log := get_log(log_folder, 'info')).exists():
+                src_folder = get_src_folder(info_log.read_text(encoding='utf-8'))
+            if not src_folder:
+                watcher.wait(interval)
+                continue
+
+            for log in get_build_logs(log_folder):
+                if log.name not in followers:
+                    followers[log.name] = lib.log_scan.LogFollower(log)
+                for line in sorted(followers[log.name].update()):
+                    line = lib.log_scan.clean_line(line, src_folder)
+                    if not ignore_matcher.search(line):
+                        lib.utils.print_yellow(f"{log.name}:{line.rstrip()}")
+
+            if changed and time.monotonic() - last_write >= interval:
+                log_problems = {name: followers[name].problems for name in sorted(followers)}
+                write_reports(log_folder, generate_report(log_folder, log_problems=log_problems),
+                              write_json)
+                last_write = time.monotonic()
+                changed = False
+
+            watcher.wait(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
 
 
 if __name__ == '__main__':
@@ -178,8 +431,18 @@ if __name__ == '__main__':
     if not (folder := Path(args.folder)).exists():
         raise RuntimeError(f"Logs folder ('{folder}') could not be found!")
 
-    report = generate_report(folder)
+    if args.watch:
+        if args.print_to_stdout:
+            raise RuntimeError('--watch cannot be used with -p / --print-to-stdout!')
+        watch(folder, args.interval, args.json)
+
+    report_data = generate_report(folder, args.jobs, args.rescan,
+                                  None if args.no_database else args.database, args.run)
     if args.print_to_stdout:
-        print(report, end='')  # report_text has '\n' at the end already
+        if args.json:
+            json.dump(report_data, sys.stdout, indent=4, sort_keys=True)
+            print()
+        else:
+            write_text_report(sys.stdout, report_data)
     else:
-        Path(folder, 'report.txt').write_text(report, encoding='utf-8')
+        write_reports(folder, report_data, args.json)
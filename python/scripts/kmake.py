@@ -10,21 +10,64 @@ import sys
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 # pylint: disable=wrong-import-position
 import lib.kernel  # noqa: E402
+import lib.utils  # noqa: E402
 # pylint: enable=wrong-import-position
 
 
 def parse_arguments():
     parser = ArgumentParser(description='A make wrapper for building Linux kernels')
 
+    parser.add_argument('--admission',
+                        action='store_true',
+                        help='Get job slots from the build admission daemon (build_admission.py)')
     parser.add_argument('-C', '--directory', help='Mirrors the equivalent make argument')
+    parser.add_argument(
+        '--artifact-cache',
+        action='store_true',
+        help='Restore build artifacts from a cache when source, configuration and toolchain match')
+    parser.add_argument('--artifact-cache-size',
+                        default='50G',
+                        help='Maximum size of the artifact cache (default: %(default)s)')
+    parser.add_argument(
+        '--changed-since',
+        help='Only build objects for C and assembly files changed since this git reference',
+        metavar='REF')
+    parser.add_argument(
+        '--distcc',
+        help="Distribute compiles with distcc to these hosts (e.g. 'builder1/16 localhost/4')",
+        metavar='HOSTS')
     parser.add_argument('--no-ccache', action='store_true', help='Disable the use of ccache')
+    parser.add_argument('--ccache-partition',
+                        action='store_true',
+                        help='Use a separate ccache directory for each compiler')
+    parser.add_argument('--ccache-size', help='Maximum size of the ccache directory (e.g. 20G)')
+    parser.add_argument('-l',
+                        '--log-file',
+                        help='Also write output to this file (.gz and .xz are compressed)')
     parser.add_argument(
         '-p',
         '--prepend-to-path',
         action='append',
         help='Prepend specified directory to PATH (can be specified multiple times)')
-    parser.add_argument('-j', '--jobs', default=os.cpu_count(), help='Number of jobs', type=int)
-    parser.add_argument('--use-time', action='store_true', help="Call 'time -v' for time tracking")
+    parser.add_argument('-j',
+                        '--jobs',
+                        help='Number of jobs (default: based on idle CPUs and available memory)',
+                        type=int)
+    parser.add_argument('--rusage-json',
+                        action='store_true',
+                        help='Write resource usage of the build to kmake_rusage.json in O')
+    parser.add_argument('--tmpfs',
+                        action='store_true',
+                        help='Build in RAM and copy the artifacts to O= if the build fits')
+    parser.add_argument('--tmpfs-folder',
+                        default='/dev/shm',
+                        help='tmpfs folder to build in with --tmpfs (default: %(default)s)')
+    parser.add_argument('--trace',
+                        help='Write a timeline of the build in Chrome trace event format',
+                        metavar='TRACE_FILE')
+    parser.add_argument('--use-time',
+                        action='store_true',
+                        help='Print detailed resource usage of the build')
     parser.add_argument('-v', '--verbose', action='store_true', help='Do a more verbose build')
     parser.add_argument('make_args', help='Make variables and targets', nargs='*')
 
@@ -55,10 +98,30 @@ if __name__ == '__main__':
             if arg not in targets:
                 targets.append(arg)
 
+    if args.changed_since:
+        kernel_src = args.directory if args.directory else '.'
+        if not (objects := lib.kernel.get_changed_objects(kernel_src, variables,
+                                                          args.changed_since)):
+            lib.utils.print_yellow(
+                f"No C or assembly files changed since {args.changed_since}, nothing to build")
+            sys.exit(0)
+        targets += [obj for obj in objects if obj not in targets]
+
     lib.kernel.kmake(variables,
                      targets,
                      ccache=(not args.no_ccache),
                      directory=args.directory,
                      jobs=args.jobs,
                      silent=(not args.verbose),
-                     use_time=args.use_time)
+                     use_time=args.use_time,
+                     rusage_json=args.rusage_json,
+                     ccache_partition=args.ccache_partition,
+                     ccache_size=args.ccache_size,
+                     log_file=args.log_file,
+                     trace_file=args.trace,
+                     artifact_cache=args.artifact_cache,
+                     artifact_cache_size=args.artifact_cache_size,
+                     distcc_hosts=args.distcc,
+                     use_admission=args.admission,
+                     tmpfs=args.tmpfs,
+                     tmpfs_folder=args.tmpfs_folder)
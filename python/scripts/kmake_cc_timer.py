@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2023 Nathan Chancellor
+# Description: Compiler wrapper that records how long each compile takes for
+# kmake's build timeline. Usage: kmake_cc_timer.py <log> <compiler> [args...]
+
+import json
+import subprocess
+import sys
+import time
+
+if __name__ == '__main__':
+    compile_log, *cc_cmd = sys.argv[1:]
+
+    start = time.time_ns()
+    returncode = subprocess.run(cc_cmd, check=False).returncode
+    end = time.time_ns()
+
+    # Only compiles that produce an object are interesting, not things such
+    # as compiler feature tests
+    output = cc_cmd[cc_cmd.index('-o') + 1] if '-o' in cc_cmd[:-1] else ''
+    if output.endswith('.o'):
+        record = {
+            'end': end,
+            'output': output,
+            'returncode': returncode,
+            'start': start,
+        }
+        # A single small write to a file opened for appending does not
+        # interleave with writes from other compiles
+        with open(compile_log, encoding='utf-8', mode='a') as file:
+            file.write(json.dumps(record) + '\n')
+
+    sys.exit(returncode)
@@ -14,6 +14,7 @@ import requests
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 # pylint: disable=wrong-import-position
+import lib.kernel  # noqa: E402
 import lib.sha256  # noqa: E402
 import lib.utils  # noqa: E402
 # pylint: enable=wrong-import-position
@@ -71,6 +72,11 @@ def get_gcc_cross_compile(major_version, arch_or_target):
     return f"{os.environ['CBL_TC_STOW_GCC']}/{version}/bin/{target}-"
 
 
+def get_gcc_info(major_version, arch_or_target):
+    return lib.kernel.probe_tool(f"{get_gcc_cross_compile(major_version, arch_or_target)}gcc",
+                                 compiler=True)
+
+
 def get_latest_gcc_version(major_version):
     return {
         6: '6.5.0',
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2023 Nathan Chancellor
+# Description: Compare how fast build logs can be scanned for problems with a
+# regular expression on every line versus with lib.log_scan's prefilters.
+
+from argparse import ArgumentParser
+from pathlib import Path
+import sys
+import time
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+# pylint: disable=wrong-import-position
+import lib.log_scan  # noqa: E402
+
+# pylint: enable=wrong-import-position
+
+
+# How cbl_gen_build_report.py used to scan logs
+def scan_per_line(log):
+    problem_re = lib.log_scan.get_problem_re()
+    ignore_re = lib.log_scan.get_ignore_re()
+    lines = log.read_bytes().decode('utf-8', errors='replace').splitlines(keepends=True)
+    problems = {line for line in lines if problem_re.search(line)}
+    return problems, {line for line in problems if not ignore_re.search(line)}
+
+
+def scan_prefiltered(log):
+    ignore_matcher = lib.log_scan.get_ignore_matcher()
+    problems = lib.log_scan.read_log_problems(log)[0]
+    return problems, {line for line in problems if not ignore_matcher.search(line)}
+
+
+# Best of several runs, to reduce the noise from other things on the machine
+def benchmark(scan, logs, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [scan(log) for log in logs]
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, results
+
+
+def count_lines(log):
+    with log.open('rb') as file:
+        return sum(chunk.count(b'\n') for chunk in iter(lambda: file.read(1048576), b''))
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Benchmark scanning build logs for problems')
+    parser.add_argument('-r',
+                        '--repeat',
+                        default=3,
+                        help='Number of times to scan the logs (default: %(default)s)',
+                        type=int)
+    parser.add_argument('logs', help='Log files or folders of logs from cbl_lkt', nargs='+')
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+
+    logs = []
+    for item in map(Path, args.logs):
+        logs += sorted(item.glob('*.log')) if item.is_dir() else [item]
+    if not logs:
+        raise RuntimeError('No logs found?')
+
+    lines = sum(count_lines(log) for log in logs)
+    size = sum(log.stat().st_size for log in logs)
+    print(f"{len(logs)} logs, {lines} lines, {size / 1024**2:.1f} MiB\n")
+
+    baseline = None
+    for name, scan in (('per-line regex', scan_per_line), ('prefiltered', scan_prefiltered)):
+        duration, results = benchmark(scan, logs, args.repeat)
+        print(f"{name}: {duration:.3f}s, {lines / duration:,.0f} lines/s, "
+              f"{size / 1024**2 / duration:.1f} MiB/s")
+        if baseline is None:
+            baseline = (duration, results)
+        else:
+            print(f"\nSpeedup: {baseline[0] / duration:.1f}x")
+            if results != baseline[1]:
+                raise RuntimeError('Prefiltered scan found different problems than per-line scan!')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,14 @@
 # Copyright (C) 2023 Nathan Chancellor
 
 from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import heapq
+import os
 from pathlib import Path
+import platform
 import shutil
 import signal
+import subprocess
 import sys
 import time
 
@@ -13,10 +18,13 @@ import time
 import tuxmake.build
 
 import korg_gcc
+import tuxmake_results
 
 sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
-# pylint: disable-next=wrong-import-position
+# pylint: disable=wrong-import-position
+import lib.admission  # noqa: E402
 import lib.utils  # noqa: E402
+# pylint: enable=wrong-import-position
 
 
 def interrupt_handler(_signum, _frame):
@@ -74,6 +82,35 @@ def parse_arguments():
         '--output-dir',
         help='Output folder for build artifacts (default: build folder in kernel source)')
 
+    parser.add_argument('-j',
+                        '--jobs',
+                        default=os.cpu_count(),
+                        help='Total number of jobs to split between builds (default: %(default)s)',
+                        type=int)
+
+    parser.add_argument('-p',
+                        '--parallel',
+                        default=1,
+                        help='Number of builds to run at the same time (default: %(default)s)',
+                        type=int)
+
+    parser.add_argument(
+        '--history',
+        default=Path(lib.utils.get_cache_folder(), 'tuxmake_bld_all_history.json'),
+        help='File to record build durations in for scheduling (default: %(default)s)')
+
+    parser.add_argument('--admission',
+                        action='store_true',
+                        help='Get job slots from the build admission daemon (build_admission.py)')
+
+    parser.add_argument('--store',
+                        default=tuxmake_results.get_default_store(),
+                        help='File to record results of all runs in (default: %(default)s)')
+
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Keep the output folder and only run builds that have not passed yet')
+
     parser.add_argument('--use-ccache',
                         action='store_true',
                         help='Use ccache for builds (default: no caching)')
@@ -112,45 +149,180 @@ def get_targets(kconfig):
     return targets
 
 
-def build_one(tree, output_dir, target_arch, toolchain, wrapper, kconfig, results_file):
+class JobBudget:
+
+    def __init__(self, jobs, parallel):
+        self.jobs = jobs
+        self.parallel = parallel
+        self.leased = []
+
+    # Split the jobs that are not held by builds in flight between the builds
+    # that can still be started, so that builds never use more than the total
+    # number of jobs between them. Once there are fewer builds left to start
+    # than free workers, the builds that start during the tail of the run get a
+    # larger share of what is free.
+    def claim(self, remaining):
+        free_workers = min(self.parallel - len(self.leased), remaining)
+        share = max(1, (self.jobs - sum(self.leased)) // max(1, free_workers))
+        self.leased.append(share)
+        return share
+
+    def release(self, share):
+        self.leased.remove(share)
+
+
+def get_toolchain_version(toolchain, target_arch):
+    major_version = int(toolchain.split('-')[1])
+    try:
+        return korg_gcc.get_gcc_info(major_version, target_arch)['version']
+    except FileNotFoundError:
+        return f"gcc-{korg_gcc.get_latest_gcc_version(major_version)}"
+
+
+# The admission lease is taken by the process doing the build so that the job
+# slots go back to the daemon as soon as it is done or dies, not whenever the
+# process scheduling the builds gets around to it.
+def build_one(tree,
+              output_dir,
+              target_arch,
+              toolchain,
+              wrapper,
+              kconfig,
+              jobs=None,
+              quiet=False,
+              use_admission=False):
     bld_str = f"ARCH={target_arch} {kconfig} {toolchain}"
 
-    lib.utils.print_header(bld_str)
+    if use_admission and jobs:
+        lease = lib.admission.acquire(jobs, f"tuxmake {bld_str}")
+    else:
+        lease = lib.admission.Lease(jobs)
+    with lease:
+        jobs = lease.slots
+        lib.utils.print_header(f"{bld_str} (-j{jobs})" if jobs else bld_str)
+
+        config_output_dir = f"{output_dir}/{target_arch}/{kconfig}"
+        Path(config_output_dir).mkdir(exist_ok=True, parents=True)
+
+        environment, make_variables = get_env_make_variables(target_arch, toolchain)
+
+        # pylint: disable-next=c-extension-no-member
+        result = tuxmake.build.build(tree=tree,
+                                     output_dir=config_output_dir,
+                                     target_arch=target_arch,
+                                     wrapper=wrapper,
+                                     kconfig=kconfig,
+                                     environment=environment,
+                                     make_variables=make_variables,
+                                     targets=get_targets(kconfig),
+                                     jobs=jobs,
+                                     quiet=quiet)
+
+    return {
+        'arch': target_arch,
+        'duration': sum(info.duration for info in result.status.values()),
+        'kconfig': kconfig,
+        'status': 'PASS' if all(info.passed for info in result.status.values()) else 'FAIL',
+        'steps': {
+            step: {
+                'duration': info.duration,
+                'status': info.status,
+            }
+            for step, info in result.status.items()
+        },
+        'toolchain': toolchain,
+        'toolchain_version': get_toolchain_version(toolchain, target_arch),
+    }
+
+
+def get_history_key(toolchain, target_arch, kconfig):
+    return f"{toolchain} {target_arch} {kconfig}"
+
+
+def average(values):
+    return sum(values) / len(values)
+
 
-    config_output_dir = f"{output_dir}/{target_arch}/{kconfig}"
-    Path(config_output_dir).mkdir(exist_ok=True, parents=True)
+# Estimate how long a build will take in seconds based on previous runs of the
+# same build, falling back to similar builds if it has never been run before
+def estimate_duration(history, toolchain, target_arch, kconfig):
+    if (durations := history.get(get_history_key(toolchain, target_arch, kconfig))):
+        return average(durations)
 
-    environment, make_variables = get_env_make_variables(target_arch, toolchain)
+    for matches in (
+            lambda key: key.split(' ')[1:] == [target_arch, kconfig],
+            lambda key: key.split(' ')[2] == kconfig,
+    ):
+        if (similar := [average(value) for key, value in history.items() if matches(key)]):
+            return average(similar)
 
-    # pylint: disable-next=c-extension-no-member
-    result = tuxmake.build.build(tree=tree,
-                                 output_dir=config_output_dir,
-                                 target_arch=target_arch,
-                                 wrapper=wrapper,
-                                 kconfig=kconfig,
-                                 environment=environment,
-                                 make_variables=make_variables,
-                                 targets=get_targets(kconfig))
+    return {
+        'allmodconfig': 30 * 60,
+        'allnoconfig': 60,
+        'defconfig': 5 * 60,
+    }[kconfig]
 
-    duration = 0
-    passed = True
-    for info in result.status.values():
-        duration += info.duration
-        passed &= info.passed
 
-    res_str = 'PASS' if passed else 'FAIL'
-    duration_str = lib.utils.get_duration(0, duration)
-    with results_file.open(encoding='utf-8', mode='a') as file:
-        file.write(f"{bld_str}: {res_str} in {duration_str}\n")
+def record_duration(history, history_file, toolchain, target_arch, kconfig, duration):
+    key = get_history_key(toolchain, target_arch, kconfig)
+    # Only keep the last few durations so that the estimate follows the tree
+    # as it grows
+    history[key] = (history.get(key, []) + [duration])[-5:]
+    lib.utils.write_json(history_file, history)
 
 
-def process_results(results_file, start_time):
+def get_kernel_head(tree):
+    git_cmd = ['git', 'rev-parse', 'HEAD']
+    if (proc := subprocess.run(git_cmd, capture_output=True, check=False, cwd=tree,
+                               text=True)).returncode:
+        return None
+    return proc.stdout.strip()
+
+
+def get_resume_key(kernel_head, toolchain, target_arch, kconfig):
+    return kernel_head, get_toolchain_version(toolchain, target_arch), target_arch, kconfig
+
+
+# Drop the builds that already passed with the same source and toolchain, as
+# well as the results of the builds that are going to be run again, so that
+# their new results replace the old ones in the results file.
+def filter_resumed_builds(builds, kernel_head, results_file):
+    records = tuxmake_results.read_records(results_file)
+    passed = {(record['kernel_commit'], record['toolchain_version'], record['arch'],
+               record['kconfig'])
+              for record in records if record['status'] == 'PASS'}
+    builds = [build for build in builds if get_resume_key(kernel_head, *build) not in passed]
+
+    rerun = set(builds)
+    tuxmake_results.write_records(
+        results_file,
+        [record for record in records if tuxmake_results.get_build_key(record) not in rerun])
+
+    return builds
+
+
+# Longest expected build first, which keeps long builds from starting at the
+# end of the run and stretching its tail
+def order_builds(builds, estimates):
+    return sorted(builds, key=lambda build: estimates[build], reverse=True)
+
+
+def estimate_total_duration(builds, estimates, parallel):
+    workers = [0.0] * parallel
+    for build in builds:
+        heapq.heappush(workers, heapq.heappop(workers) + estimates[build])
+    return max(workers)
+
+
+def process_results(results_file, log_file, start_time):
     print()
 
     failed = []
     passed = []
-    for line in results_file.read_text(encoding='utf-8').splitlines(keepends=True):
-        (passed if 'PASS' in line else failed).append(line)
+    for record in tuxmake_results.read_records(results_file):
+        line = tuxmake_results.get_result_str(record) + '\n'
+        (passed if record['status'] == 'PASS' else failed).append(line)
+    log_file.write_text(''.join(passed + failed), encoding='utf-8')
 
     if passed:
         print('Successful builds:\n')
@@ -163,20 +335,136 @@ def process_results(results_file, start_time):
     print(f"Total build time: {lib.utils.get_duration(start_time)}")
 
 
-def build_all(linux_folder, out_folder, architectures, targets, toolchains, use_ccache,
-              results_file):
+# Deleting a large output folder can take minutes, so rename it out of the way
+# (which is atomic on the same file system) and delete it at idle priority in
+# a separate session, which lets the builds start right away and keeps an
+# interrupt of this script from stopping the deletion.
+def remove_in_background(folder):
+    try:
+        folder.rename(folder.with_name(f".{folder.name}.old-{time.time_ns()}"))
+    except OSError:
+        # The folder may be a mount point, which cannot be renamed
+        shutil.rmtree(folder)
+        return
+
+    # Pick up folders from previous runs whose deletion did not finish
+    trashes = sorted(folder.parent.glob(f".{folder.name}.old-*"))
+    rm_cmd = ['nice', '-n', '19', 'rm', '-fr', *trashes]
+    if shutil.which('ionice'):
+        rm_cmd = ['ionice', '-c', '3', *rm_cmd]
+    # pylint: disable-next=consider-using-with
+    subprocess.Popen(rm_cmd, start_new_session=True)
+
+
+def get_builds(architectures, targets, toolchains):
+    builds = []
     for toolchain in toolchains:
         for target_arch in architectures:
             if int(toolchain.split('-')[1]) < 7 and target_arch == 'riscv':
                 continue
             for kconfig in get_kconfigs_for_target(targets):
-                build_one(tree=linux_folder,
-                          output_dir=out_folder,
-                          target_arch=target_arch,
-                          toolchain=toolchain,
-                          wrapper='ccache' if use_ccache and shutil.which('ccache') else None,
-                          kconfig=kconfig,
-                          results_file=results_file)
+                builds.append((toolchain, target_arch, kconfig))
+    return builds
+
+
+def build_all(linux_folder,
+              out_folder,
+              architectures,
+              targets,
+              toolchains,
+              use_ccache,
+              results_file,
+              jobs=None,
+              parallel=1,
+              history_file=None,
+              resume=False,
+              store=None,
+              use_admission=False):
+    history = lib.utils.read_json(history_file) if history_file else {}
+    builds = get_builds(architectures, targets, toolchains)
+
+    if not (kernel_head := get_kernel_head(linux_folder)) and resume:
+        raise RuntimeError(f"Could not get HEAD of '{linux_folder}', cannot resume?")
+    if resume:
+        total = len(builds)
+        builds = filter_resumed_builds(builds, kernel_head, results_file)
+        if (skipped := total - len(builds)):
+            lib.utils.print_green(f"Skipping {skipped} builds that already passed")
+
+    estimates = {build: estimate_duration(history, *build) for build in builds}
+    builds = order_builds(builds, estimates)
+    if not jobs:
+        jobs = os.cpu_count()
+    parallel = max(1, min(parallel, len(builds)))
+    eta = lib.utils.get_duration(0, estimate_total_duration(builds, estimates, parallel))
+    lib.utils.print_green(f"Estimated total build time: {eta}")
+    budget = JobBudget(jobs, parallel)
+    wrapper = 'ccache' if use_ccache and shutil.which('ccache') else None
+    run_info = {
+        'host': platform.node(),
+        'kernel_commit': kernel_head,
+        'run': time.strftime('%Y-%m-%d-%H:%M:%S'),
+    }
+
+    def start_build(toolchain, target_arch, kconfig, remaining):
+        share = budget.claim(remaining)
+        build_kwargs = {
+            'tree': linux_folder,
+            'output_dir': out_folder,
+            'target_arch': target_arch,
+            'toolchain': toolchain,
+            'wrapper': wrapper,
+            'kconfig': kconfig,
+            'jobs': share,
+            'quiet': parallel > 1,
+            'use_admission': use_admission,
+        }
+        return share, build_kwargs
+
+    def finish_build(share, record):
+        budget.release(share)
+        record.update(run_info, time=time.time())
+
+        tuxmake_results.append_record(results_file, record)
+        if store:
+            tuxmake_results.append_record(store, record)
+        # Failed builds stop early, so their duration says nothing about how
+        # long a successful build would take.
+        if record['status'] == 'PASS' and history_file:
+            record_duration(history, history_file, record['toolchain'], record['arch'],
+                            record['kconfig'], record['duration'])
+
+        if parallel > 1:
+            if record['status'] == 'PASS':
+                lib.utils.print_green(tuxmake_results.get_result_str(record))
+            else:
+                lib.utils.print_yellow(tuxmake_results.get_result_str(record))
+
+    # tuxmake installs signal handlers while building, which can only be done
+    # from the main thread, so a single build runs here and builds that run at
+    # the same time each get their own process.
+    if parallel == 1:
+        for index, build in enumerate(builds):
+            share, build_kwargs = start_build(*build, len(builds) - index)
+            finish_build(share, build_one(**build_kwargs))
+        return
+
+    # Builds are started and finished from this process, so that the budget
+    # and results are only ever touched from one place
+    pending = list(builds)
+    running = {}
+    executor = ProcessPoolExecutor(max_workers=parallel)
+    try:
+        while pending or running:
+            while pending and len(running) < parallel:
+                remaining = len(pending)
+                share, build_kwargs = start_build(*pending.pop(0), remaining)
+                running[executor.submit(build_one, **build_kwargs)] = share
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                finish_build(running.pop(future), future.result())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 if __name__ == '__main__':
@@ -187,10 +475,10 @@ if __name__ == '__main__':
     if not (output := args.output_dir):
         output = Path(args.directory, 'build')
 
-    if (output := Path(output).resolve()).exists():
-        shutil.rmtree(output)
+    if (output := Path(output).resolve()).exists() and not args.resume:
+        remove_in_background(output)
 
-    results = Path(output, 'results.log')
+    results = Path(output, 'results.jsonl')
     start = time.time()
 
     build_all(linux_folder=Path(args.directory).resolve(),
@@ -199,6 +487,12 @@ if __name__ == '__main__':
               targets=args.targets,
               toolchains=args.toolchains,
               use_ccache=args.use_ccache,
-              results_file=results)
-
-    process_results(results, start)
+              results_file=results,
+              jobs=args.jobs,
+              parallel=args.parallel,
+              history_file=Path(args.history),
+              resume=args.resume,
+              store=Path(args.store),
+              use_admission=args.admission)
+
+    process_results(results, Path(output, 'results.log'), start)
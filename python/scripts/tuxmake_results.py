@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2023 Nathan Chancellor
+
+from argparse import ArgumentParser
+import json
+from pathlib import Path
+import sys
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+# pylint: disable=wrong-import-position
+import lib.utils  # noqa: E402
+# pylint: enable=wrong-import-position
+
+
+def get_default_store():
+    return Path(lib.utils.get_cache_folder(), 'tuxmake_results.jsonl')
+
+
+def append_record(store, record):
+    (store := Path(store)).parent.mkdir(exist_ok=True, parents=True)
+    with store.open(encoding='utf-8', mode='a') as file:
+        file.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def read_records(store):
+    if not (store := Path(store)).exists():
+        return []
+    with store.open(encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def write_records(store, records):
+    (store := Path(store)).parent.mkdir(exist_ok=True, parents=True)
+    store.write_text(''.join(json.dumps(record, sort_keys=True) + '\n' for record in records),
+                     encoding='utf-8')
+
+
+def get_build_key(record):
+    return record['toolchain'], record['arch'], record['kconfig']
+
+
+def get_bld_str(record):
+    return f"ARCH={record['arch']} {record['kconfig']} {record['toolchain']}"
+
+
+def get_result_str(record):
+    duration = lib.utils.get_duration(0, record['duration'])
+    return f"{get_bld_str(record)}: {record['status']} in {duration}"
+
+
+# Dictionary of run name to the records of that run, ordered oldest to newest
+def get_runs(records):
+    runs = {}
+    for record in sorted(records, key=lambda item: item['time']):
+        runs.setdefault(record['run'], []).append(record)
+    return runs
+
+
+def resolve_run(runs, run, default_index):
+    if not runs:
+        raise RuntimeError('No runs found in results store?')
+    if not run:
+        return list(runs)[default_index]
+    if run not in runs:
+        raise RuntimeError(f"Run ('{run}') could not be found in results store?")
+    return run
+
+
+def format_delta(base, new):
+    if not base:
+        return ''
+    return f" ({(new - base) / base * 100:+.1f}%)"
+
+
+def list_runs(records):
+    for run, run_records in get_runs(records).items():
+        first = run_records[0]
+        passed = sum(record['status'] == 'PASS' for record in run_records)
+        duration = lib.utils.get_duration(0, sum(record['duration'] for record in run_records))
+        commit = (first['kernel_commit'] or 'unknown')[:12]
+        print(f"{run}: {first['host']} {commit} "
+              f"{passed}/{len(run_records)} passed, {duration} of build time")
+
+
+def show_run(records, run):
+    runs = get_runs(records)
+    run = resolve_run(runs, run, -1)
+    first = runs[run][0]
+
+    print(f"Run: {run}\nHost: {first['host']}\nKernel commit: {first['kernel_commit']}\n")
+    for record in sorted(runs[run], key=get_build_key):
+        print(get_result_str(record))
+        for step, info in record['steps'].items():
+            print(f"    {step}: {info['status']} in {lib.utils.get_duration(0, info['duration'])}")
+
+
+def compare_runs(records, base_run, new_run):
+    runs = get_runs(records)
+    base_run = resolve_run(runs, base_run, -2 if len(runs) > 1 else -1)
+    new_run = resolve_run(runs, new_run, -1)
+    base = {get_build_key(record): record for record in runs[base_run]}
+    new = {get_build_key(record): record for record in runs[new_run]}
+
+    print(f"Comparing {base_run} (base) to {new_run} (new)\n")
+    for key in sorted(base.keys() & new.keys()):
+        base_record, new_record = base[key], new[key]
+        print(f"{get_bld_str(new_record)}: {base_record['status']} -> {new_record['status']}")
+        for step in sorted(base_record['steps'].keys() & new_record['steps'].keys()):
+            base_duration = base_record['steps'][step]['duration']
+            new_duration = new_record['steps'][step]['duration']
+            print(f"    {step}: {lib.utils.get_duration(0, base_duration)} -> "
+                  f"{lib.utils.get_duration(0, new_duration)}"
+                  f"{format_delta(base_duration, new_duration)}")
+
+    sections = {
+        'Only in base run': base.keys() - new.keys(),
+        'Only in new run': new.keys() - base.keys(),
+    }
+    for title, keys in sections.items():
+        if keys:
+            print(f"\n{title}:\n")
+            for key in sorted(keys):
+                print(get_result_str(base.get(key) or new.get(key)))
+
+
+# Print comma separated values, which can be fed straight into a plotting tool
+def show_history(records, arch, kconfig, toolchain, step):
+    print('run,host,kernel_commit,toolchain_version,status,duration')
+    for record in sorted(records, key=lambda item: item['time']):
+        if (record['arch'], record['kconfig'], record['toolchain']) != (arch, kconfig, toolchain):
+            continue
+        info = record['steps'].get(step) if step else record
+        if not info:
+            continue
+        print(f"{record['run']},{record['host']},{record['kernel_commit']},"
+              f"{record['toolchain_version']},{info['status']},{info['duration']:.2f}")
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Query build results recorded by tuxmake_bld_all.py')
+
+    parser.add_argument('-s',
+                        '--store',
+                        default=get_default_store(),
+                        help='Results store to query (default: %(default)s)')
+
+    subparser = parser.add_subparsers(dest='subcommand', metavar='SUBCOMMAND', required=True)
+
+    subparser.add_parser('runs', help='List recorded runs')
+
+    show_parser = subparser.add_parser('show', help='Show the results of a run')
+    show_parser.add_argument('run', help='Run to show (default: latest run)', nargs='?')
+
+    compare_parser = subparser.add_parser('compare', help='Compare durations between two runs')
+    compare_parser.add_argument('base', help='Base run (default: second to last run)', nargs='?')
+    compare_parser.add_argument('new', help='New run (default: latest run)', nargs='?')
+
+    history_parser = subparser.add_parser('history',
+                                          help='Print durations of one build across all runs')
+    history_parser.add_argument('-a', '--arch', help='Architecture of build', required=True)
+    history_parser.add_argument('-k', '--kconfig', help='Configuration of build', required=True)
+    history_parser.add_argument('-t', '--toolchain', help='Toolchain of build', required=True)
+    history_parser.add_argument('--step', help='Only show this tuxmake step (default: whole build)')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    results = read_records(args.store)
+
+    if args.subcommand == 'runs':
+        list_runs(results)
+    if args.subcommand == 'show':
+        show_run(results, args.run)
+    if args.subcommand == 'compare':
+        compare_runs(results, args.base, args.new)
+    if args.subcommand == 'history':
+        show_history(results, args.arch, args.kconfig, args.toolchain, args.step)
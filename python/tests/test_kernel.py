@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2023 Nathan Chancellor
+
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+# pylint: disable=wrong-import-position
+import lib.kernel  # noqa: E402
+# pylint: enable=wrong-import-position
+
+# Just enough of a kernel tree for kmake(): configuration targets write a
+# .config and everything else leaves a marker behind
+MAKEFILE = '''\
+VERSION = 6
+PATCHLEVEL = 6
+SUBLEVEL = 0
+EXTRAVERSION =
+O ?= .
+defconfig olddefconfig:
+\t@mkdir -p $(O)
+\t@echo CONFIG_X=y > $(O)/.config
+all:
+\t@mkdir -p $(O)
+\t@echo built > $(O)/built
+'''
+
+TOOLS = {
+    'as': 'echo "GNU assembler (GNU Binutils) 2.41"',
+    'gcc': '[ "$1" = -dumpmachine ] && echo x86_64-linux-gnu || echo "gcc (GCC) 13.2.0"',
+}
+
+
+class KmakeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.tmp = tmp = Path(self.tmp_dir.name)
+
+        self.kernel_src = Path(tmp, 'linux')
+        self.kernel_src.mkdir()
+        Path(self.kernel_src, 'Makefile').write_text(MAKEFILE, encoding='utf-8')
+        Path(self.kernel_src, 'arch').mkdir()
+        # The artifact cache key includes the git state of the tree
+        Path(self.kernel_src, '.gitignore').write_text('build/\n', encoding='utf-8')
+        git_cmds = [
+            ['init', '-q'],
+            ['add', '.'],
+            ['-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-qm', 'init'],
+        ]
+        for git_cmd in git_cmds:
+            subprocess.run(['git', *git_cmd], check=True, cwd=self.kernel_src)
+
+        (bin_dir := Path(tmp, 'bin')).mkdir()
+        for name, script in TOOLS.items():
+            (tool := Path(bin_dir, name)).write_text(f"#!/bin/sh\n{script}\n", encoding='utf-8')
+            tool.chmod(0o755)
+
+        env = {
+            'PATH': f"{bin_dir}:{os.environ['PATH']}",
+            'XDG_CACHE_HOME': str(Path(tmp, 'cache')),
+        }
+        patchers = [
+            mock.patch.dict(os.environ, env),
+            # Temporary files, such as the log of compiles for traces
+            mock.patch.object(tempfile, 'tempdir', str(tmp)),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def kmake(self, targets, **kwargs):
+        out_dir = Path(self.kernel_src, 'build')
+        return out_dir, lib.kernel.kmake({'O': 'build'},
+                                         targets,
+                                         ccache=False,
+                                         directory=self.kernel_src,
+                                         jobs=1,
+                                         **kwargs)
+
+    def test_artifact_cache_config_only(self):
+        out_dir, result = self.kmake(['defconfig'], artifact_cache=True)
+
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.make_cmd[-1], 'defconfig')
+        self.assertTrue(Path(out_dir, '.config').exists())
+        # An empty list of targets would build the default target
+        self.assertFalse(Path(out_dir, 'built').exists())
+
+    def test_artifact_cache_config_and_build(self):
+        out_dir, result = self.kmake(['defconfig', 'all'], artifact_cache=True)
+
+        self.assertEqual(result.returncode, 0)
+        self.assertTrue(Path(out_dir, '.config').exists())
+        self.assertTrue(Path(out_dir, 'built').exists())
+
+    def test_trace_compile_log_removed(self):
+        trace_file = Path(self.tmp, 'trace.json')
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.kmake(['missingconfig'], artifact_cache=True, trace_file=trace_file)
+        self.assertEqual(list(self.tmp.glob('kmake-compiles-*')), [])
+
+        self.kmake(['defconfig', 'all'], trace_file=trace_file)
+        self.assertEqual(list(self.tmp.glob('kmake-compiles-*')), [])
+        self.assertTrue(trace_file.exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) 2023 Nathan Chancellor
+
+from pathlib import Path
+import re
+import sys
+import unittest
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+# pylint: disable=wrong-import-position
+import lib.log_scan  # noqa: E402
+# pylint: enable=wrong-import-position
+
+# Patterns with escapes that match classes of characters or positions, along
+# with text that they do and do not match
+PATTERNS = {
+    r'\dxyz': ['1xyz', 'dxyz', 'xyz'],
+    r'a\sbc': ['a bc', 'asbc', 'abc'],
+    r'\bobjtool\b: x': ['objtool: x', 'bobjtoolb: x', 'xobjtool: x'],
+    r'\w+ warning: \S+': ['foo warning: bar', 'w warning: S', ' warning: '],
+    r'file\.c:\d+': ['file.c:10', 'filexc:10', 'file.c:d'],
+    r'(foo|bar)\.o': ['foo.o', 'bar.o', 'baz.o'],
+}
+
+
+class PrefilterMatcherTest(unittest.TestCase):
+
+    def assert_agrees(self, pattern, text):
+        match = lib.log_scan.PrefilterMatcher([pattern]).search(text)
+        expected = re.search(pattern, text)
+        self.assertEqual(match and match.group(), expected and expected.group(),
+                         f"{pattern!r} on {text!r}")
+
+    def test_escapes(self):
+        for pattern, texts in PATTERNS.items():
+            for text in texts:
+                self.assert_agrees(pattern, text)
+
+    def test_required_literal(self):
+        self.assertEqual(lib.log_scan.get_required_literal(r'\dxyz'), 'xyz')
+        self.assertEqual(lib.log_scan.get_required_literal(r'a\sbc'), 'bc')
+        self.assertEqual(lib.log_scan.get_required_literal(r'foo\.bar'), 'foo.bar')
+        self.assertIsNone(lib.log_scan.get_required_literal('foo|bar'))
+
+
+class LogScannerTest(unittest.TestCase):
+
+    def test_line_endings(self):
+        scanner = lib.log_scan.LogScanner()
+        scanner.feed(b'a.c:1:1: warning: crlf\r\nb.c:1:1: warning: cr\rc.c:1:1: warning: lf\n')
+        scanner.feed(b'a.c:1:1: warning: crlf\n')
+        scanner.finish()
+        self.assertEqual(scanner.problems, {
+            'a.c:1:1: warning: crlf\n',
+            'b.c:1:1: warning: cr\n',
+            'c.c:1:1: warning: lf\n',
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()